@@ -0,0 +1,201 @@
+# Benchmarks for the expression server building blocks
+# Usage: python benchmark.py [reader|evaluator|writer|check]
+
+import socket
+import struct
+import sys
+import threading
+import time
+import evaluator
+import expression_client
+import helper
+import utils
+
+class CountingSocket:
+    '''
+    Wrap a socket and count the recv and send calls made on it.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = 0
+
+    def recv(self, n):
+        self.calls += 1
+        return self.conn.recv(n)
+
+    def recv_into(self, buf):
+        self.calls += 1
+        return self.conn.recv_into(buf)
+
+    def sendall(self, data):
+        self.calls += 1
+        return self.conn.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.conn.sendmsg(buffers)
+
+def legacy_read_n_bytes(conn, n):
+    # the original 16-byte loop, kept here as the baseline
+    data = bytearray()
+    while len(data) < n:
+        remain_bytes = n - len(data)
+        read_len = min(16, remain_bytes)
+        data += conn.recv(read_len)
+    return data
+
+def legacy_write_expressions(conn, exprs):
+    # one sendall per field, as the original writer did
+    conn.sendall(struct.pack('!h', len(exprs)))
+    for expr in exprs:
+        conn.sendall(struct.pack('!h', len(expr)))
+        conn.sendall(expr)
+
+def legacy_format(messages):
+    # a new format string per message, as the original helper.format did
+    offset = 0
+    result = bytearray(2 + len(messages) * 2 + helper.bytes_list_length(messages))
+    struct.pack_into('!h', result, offset, len(messages))
+    offset += 2
+    for message in messages:
+        struct.pack_into('!h', result, offset, len(message))
+        offset += 2
+        struct.pack_into('!' + str(len(message)) + 's', result, offset, message)
+        offset += len(message)
+    return result
+
+def legacy_read_expressions(conn):
+    exprs = []
+    (exprs_num,) = struct.unpack('!h', legacy_read_n_bytes(conn, 2))
+    for i in range(exprs_num):
+        (expr_len,) = struct.unpack('!h', legacy_read_n_bytes(conn, 2))
+        exprs.append(legacy_read_n_bytes(conn, expr_len))
+    return exprs
+
+def run_reader(name, read, request, rounds):
+    '''
+    Push the request through a socket pair and read it back.
+    Return
+    (tuple): recv calls per request and seconds per request
+    '''
+    a, b = socket.socketpair()
+    counter = CountingSocket(b)
+    sender = threading.Thread(target=lambda: [a.sendall(request) for i in range(rounds)])
+    sender.start()
+    start = time.perf_counter()
+    read(counter, rounds)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    a.close()
+    b.close()
+    print(f'{name:>8}: {counter.calls / rounds:10.1f} recv calls/request, '
+          f'{elapsed / rounds * 1e6:10.1f} us/request')
+
+def bench_reader():
+    def legacy(conn, rounds):
+        for i in range(rounds):
+            legacy_read_expressions(conn)
+
+    def buffered(conn, rounds):
+        reader = utils.SocketReader(conn)
+        for i in range(rounds):
+            utils.read_expressions(reader)
+
+    cases = [
+        ('1 x 30KB', [b'1+' * 15000 + b'1']),
+        ('100 x 300B', [b'1+' * 150 + b'1'] * 100),
+        ('1000 x 5B', [b'12+34'] * 1000),
+    ]
+    for label, exprs in cases:
+        request = bytes(helper.format(exprs))
+        rounds = 50
+        print(label)
+        run_reader('legacy', legacy, request, rounds)
+        run_reader('buffered', buffered, request, rounds)
+
+def check_v2_responses():
+    '''
+    Read pipelined v2 responses through a reader whose buffer is smaller
+    than them, so chunks cross the buffer boundary, and compare the values.
+    Exits with status 1 if any of them differs.
+    '''
+    responses = [[b'%d' % (i * 7919 + j) for j in range(20)] + [b'7' * 100] for i in range(50)]
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=lambda: [a.sendall(helper.format_v2(r)) for r in responses])
+    sender.start()
+    reader = utils.SocketReader(b, 64)
+    received = [expression_client.read_response(reader) for r in responses]
+    sender.join()
+    a.close()
+    b.close()
+    expected = [[expr.decode('utf8') for expr in r] for r in responses]
+    for i, (got, want) in enumerate(zip(received, expected)):
+        if got != want:
+            print(f'v2 response {i} read across the buffer boundary differs: {got!r} != {want!r}')
+            sys.exit(1)
+    print('v2 responses across the buffer boundary: ok')
+
+def bench_evaluator():
+    expression = b'+'.join(b'%d' % (i * 37 % 1000) for i in range(200))
+    for count in [1, 100, 10000]:
+        exprs = [expression] * count
+        rounds = max(1, 1000 // count)
+        start = time.perf_counter()
+        for i in range(rounds):
+            evaluator.evaluate_expressions([expr.decode('utf8') for expr in exprs])
+        per_char = (time.perf_counter() - start) / rounds
+        # a zero byte budget turns the result cache off
+        evaluator.result_cache = evaluator.ExpressionCache(0)
+        start = time.perf_counter()
+        for i in range(rounds):
+            evaluator.evaluate_batch(exprs)
+        batch = (time.perf_counter() - start) / rounds
+        evaluator.result_cache = evaluator.ExpressionCache()
+        start = time.perf_counter()
+        for i in range(rounds):
+            evaluator.evaluate_batch(exprs)
+        cached = (time.perf_counter() - start) / rounds
+        print(f'{count:>6} expressions: per-char {per_char * 1e3:10.3f} ms, '
+              f'batch {batch * 1e3:10.3f} ms ({per_char / batch:5.1f}x), '
+              f'cached {cached * 1e3:10.3f} ms ({per_char / cached:5.1f}x)')
+
+def bench_writer():
+    for count in [1, 100, 10000]:
+        exprs = [b'%d' % (i * 7919) for i in range(count)]
+        rounds = max(10, 10000 // count)
+        print(f'{count} results per response')
+        for name, write in [('legacy', legacy_write_expressions), ('sendmsg', utils.write_expressions)]:
+            a, b = socket.socketpair()
+            counter = CountingSocket(a)
+            size = len(helper.format(exprs)) * rounds
+            drain = threading.Thread(target=utils.read_n_bytes, args=(b, size))
+            drain.start()
+            start = time.perf_counter()
+            for i in range(rounds):
+                write(counter, exprs)
+            drain.join()
+            elapsed = time.perf_counter() - start
+            a.close()
+            b.close()
+            print(f'{name:>10}: {counter.calls / rounds:10.1f} send calls/response, '
+                  f'{elapsed / rounds * 1e6:10.1f} us/response')
+        for name, format in [('legacy fmt', legacy_format), ('struct fmt', helper.format)]:
+            start = time.perf_counter()
+            for i in range(rounds):
+                format(exprs)
+            elapsed = time.perf_counter() - start
+            print(f'{name:>10}: {elapsed / rounds * 1e6:10.1f} us/format')
+
+benchmarks = {
+    'reader': bench_reader,
+    'evaluator': bench_evaluator,
+    'writer': bench_writer,
+    'check': check_v2_responses,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python benchmark.py [' + '|'.join(benchmarks) + ']')
+        sys.exit(1)
+    benchmarks[sys.argv[1]]()
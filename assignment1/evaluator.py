@@ -0,0 +1,348 @@
+# Evaluators for '+' '-' expressions
+# Auther: Yuanjie Yuanjie
+# Date: 09/25/19
+
+import asyncio
+import multiprocessing
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# a term is a run of digits with the operator right before it, if any
+term_pattern = re.compile(rb'[+-]?[0-9]+')
+
+# every byte the per-char evaluator ignores
+ignored_bytes = bytes(i for i in range(256) if chr(i) not in '0123456789+-')
+
+# byte budget of the result cache, keys and values included
+cache_max_bytes = 64 * 1024 * 1024
+
+# requests with fewer uncached bytes than this are evaluated inline, since
+# shipping them to a worker process costs more than evaluating them
+inline_max_bytes = 256 * 1024
+
+# bytes of expressions sent to a worker process in one task
+task_bytes = 256 * 1024
+
+class ExpressionCache:
+    '''
+    Thread-safe LRU cache of evaluation results keyed on the normalized
+    expression. Keys and values together never take more than max_bytes;
+    the least recently used entries are evicted first.
+    '''
+
+    def __init__(self, max_bytes=cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''
+        Look up a cached result, marking it as recently used.
+        Params:
+        key: normalized expression
+        Return:
+        the cached result, or None on a miss
+        '''
+        with self.lock:
+            val = self.entries.get(key)
+            if val is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        '''
+        Store a result, evicting old entries to stay within the byte budget.
+        Params:
+        key: normalized expression
+        val: its evaluation
+        '''
+        cost = len(key) + len(val)
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(key) + len(old)
+            self.entries[key] = val
+            self.size += cost
+            while self.size > self.max_bytes:
+                old_key, old_val = self.entries.popitem(last=False)
+                self.size -= len(old_key) + len(old_val)
+
+    def stats(self):
+        '''
+        Return:
+        (tuple): hits, misses, entries and bytes used
+        '''
+        with self.lock:
+            return (self.hits, self.misses, len(self.entries), self.size)
+
+# results shared by every connection of the server
+result_cache = ExpressionCache()
+
+def evaluate_expressions(expressions):
+    '''
+    Evaluate the expressions in the given list.
+    Params:
+    expressions (list) : a list of expressions string.
+    Return:
+    (list) : a list of evaluations bytes.
+    '''
+    return [evaluate_expression(expression).encode('utf8') for expression in expressions]
+
+def evaluate_expression(expression):
+    '''
+    Evaluate an expression.
+    Params:
+    expression (str) : an expression that contains '+' '-'
+    Return:
+    (str) : the evaluation as a string.
+    '''
+    items = list(expression.strip())
+    i, nums = 0, len(items)
+    val, sign, curr_val = 0, 1, 0
+    while i < nums:
+        curr = items[i]
+        if curr.isdigit():
+            curr_val = curr_val * 10 + int(curr)
+        if curr in '+-' or i == nums - 1:
+            val += sign * curr_val
+            sign = 1 if curr == '+' else -1
+            curr_val = 0
+        i += 1
+    return str(val)
+
+def evaluate_batch(expressions):
+    '''
+    Evaluate all the expressions of a request in one pass. Each expression
+    is split into signed terms in C and the terms are converted with bulk
+    int() calls, giving the same results as evaluate_expression. Results
+    are memoized in result_cache.
+    Params:
+    expressions (list) : a list of expressions as bytes.
+    Return:
+    (list) : a list of evaluations bytes.
+    '''
+    cache_get, cache_put = result_cache.get, result_cache.put
+    results = []
+    for expression in expressions:
+        expression = bytes(expression).translate(None, ignored_bytes)
+        result = cache_get(expression)
+        if result is None:
+            result = b'%d' % sum_terms(expression)
+            cache_put(expression, result)
+        results.append(result)
+    return results
+
+def sum_terms(expression):
+    '''
+    Sum the signed terms of an expression holding only digits and '+' '-'.
+    Params:
+    expression (bytes) : the normalized expression
+    Return:
+    (int) : the value of the expression.
+    '''
+    try:
+        return sum(map(int, filter(None, expression.replace(b'-', b'+-').split(b'+'))))
+    except ValueError:
+        # back-to-back operators leave a bare sign, the regex sorts them out
+        return sum(map(int, term_pattern.findall(expression)))
+
+def evaluate_normalized(expressions):
+    '''
+    Evaluate normalized expressions without the cache; this is the task
+    run by the worker processes of ProcessBackend.
+    Params:
+    expressions (list) : a list of normalized expressions as bytes.
+    Return:
+    (list) : a list of evaluations bytes.
+    '''
+    return [b'%d' % sum_terms(expression) for expression in expressions]
+
+class ProcessBackend:
+    '''
+    Evaluate large requests on a pool of worker processes so evaluation is
+    not bound to the one core the GIL allows. Cached expressions are
+    answered in the server process, and when the rest is smaller than
+    inline_max_bytes it is evaluated inline as well. Otherwise it is cut
+    into tasks of about task_bytes which the workers evaluate in parallel.
+    Params:
+    processes (int) : the number of worker processes
+    '''
+
+    def __init__(self, processes, inline_max_bytes=inline_max_bytes, task_bytes=task_bytes):
+        self.inline_max_bytes = inline_max_bytes
+        self.task_bytes = task_bytes
+        # the server scripts run at import time, so workers are forked
+        # rather than spawned by importing the main module again
+        self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+        # fork every worker now, while the server has no other threads
+        self.executor.submit(evaluate_normalized, []).result()
+
+    def split(self, expressions):
+        '''
+        Normalize the expressions and look them up in the cache.
+        Return:
+        (tuple): results with None for every miss, the indexes of the
+        misses, their normalized expressions and their total size
+        '''
+        results, misses, missed, size = [], [], [], 0
+        for expression in expressions:
+            expression = bytes(expression).translate(None, ignored_bytes)
+            result = result_cache.get(expression)
+            if result is None:
+                misses.append(len(results))
+                missed.append(expression)
+                size += len(expression)
+            results.append(result)
+        return (results, misses, missed, size)
+
+    def tasks(self, missed):
+        '''
+        Cut the missed expressions into tasks of about task_bytes.
+        '''
+        tasks, task, size = [], [], 0
+        for expression in missed:
+            task.append(expression)
+            size += len(expression)
+            if size >= self.task_bytes:
+                tasks.append(task)
+                task, size = [], 0
+        if task:
+            tasks.append(task)
+        return tasks
+
+    def merge(self, results, misses, missed, evaluations):
+        for i, expression, result in zip(misses, missed, evaluations):
+            result_cache.put(expression, result)
+            results[i] = result
+        return results
+
+    def evaluate(self, expressions):
+        '''
+        Evaluate a request, blocking the calling thread.
+        Params:
+        expressions (list) : a list of expressions as bytes.
+        Return:
+        (list) : a list of evaluations bytes.
+        '''
+        results, misses, missed, size = self.split(expressions)
+        if size < self.inline_max_bytes:
+            return self.merge(results, misses, missed, evaluate_normalized(missed))
+        futures = [self.executor.submit(evaluate_normalized, task) for task in self.tasks(missed)]
+        evaluations = []
+        for future in futures:
+            evaluations.extend(future.result())
+        return self.merge(results, misses, missed, evaluations)
+
+    def submit(self, expressions):
+        '''
+        Evaluate a request without waiting for the workers. Requests
+        evaluated inline are done when this returns.
+        Params:
+        expressions (list) : a list of expressions as bytes.
+        Return:
+        (Future) : resolves to the list of evaluations bytes.
+        '''
+        future = Future()
+        results, misses, missed, size = self.split(expressions)
+        if size < self.inline_max_bytes:
+            future.set_result(self.merge(results, misses, missed, evaluate_normalized(missed)))
+            return future
+        tasks = [self.executor.submit(evaluate_normalized, task) for task in self.tasks(missed)]
+        lock = threading.Lock()
+        remaining = [len(tasks)]
+
+        def task_done(task):
+            # runs on the thread of the executor that finished the task
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                evaluations = [result for task in tasks for result in task.result()]
+            except Exception as e:
+                future.set_exception(e)
+                return
+            future.set_result(self.merge(results, misses, missed, evaluations))
+
+        for task in tasks:
+            task.add_done_callback(task_done)
+        return future
+
+    async def evaluate_async(self, expressions):
+        '''
+        Evaluate a request without blocking the event loop.
+        Params:
+        expressions (list) : a list of expressions as bytes.
+        Return:
+        (list) : a list of evaluations bytes.
+        '''
+        results, misses, missed, size = self.split(expressions)
+        if size < self.inline_max_bytes:
+            return self.merge(results, misses, missed, evaluate_normalized(missed))
+        futures = [asyncio.wrap_future(self.executor.submit(evaluate_normalized, task))
+                   for task in self.tasks(missed)]
+        evaluations = []
+        for task_results in await asyncio.gather(*futures):
+            evaluations.extend(task_results)
+        return self.merge(results, misses, missed, evaluations)
+
+    def close(self):
+        '''
+        Stop the worker processes, dropping the tasks not started yet.
+        '''
+        self.executor.shutdown(cancel_futures=True)
+
+class StreamEvaluator:
+    '''
+    Evaluate one expression incrementally as its bytes arrive. Only the
+    running value and the term cut by the last chunk are kept, so memory
+    does not grow with the length of the expression.
+    '''
+
+    def __init__(self):
+        self.val = 0
+        self.pending = b''
+
+    def feed(self, chunk):
+        '''
+        Add the next chunk of the expression.
+        Params:
+        chunk (bytes) : the next bytes of the expression
+        '''
+        data = self.pending + bytes(chunk).translate(None, ignored_bytes)
+        # every term before the last operator is complete
+        cut = max(data.rfind(b'+'), data.rfind(b'-'))
+        if cut > 0:
+            self.val += sum_terms(data[:cut])
+            data = data[cut:]
+        self.pending = data
+
+    def result(self):
+        '''
+        Return:
+        (bytes) : the evaluation of everything fed so far.
+        '''
+        return b'%d' % (self.val + sum_terms(self.pending))
+
+def evaluate_stream(chunks):
+    '''
+    Evaluate an expression given as an iterable of chunks.
+    Params:
+    chunks (iterable) : the bytes of the expression in order
+    Return:
+    (bytes) : the evaluation.
+    '''
+    stream_evaluator = StreamEvaluator()
+    for chunk in chunks:
+        stream_evaluator.feed(chunk)
+    return stream_evaluator.result()
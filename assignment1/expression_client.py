@@ -0,0 +1,205 @@
+# Client library for the expression server
+# Auther: Yuanjie Yuanjie
+# Date: 09/25/19
+
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import helper
+import utils
+
+def read_response(reader):
+    '''
+    Read one v1 or v2 response.
+    Params:
+    reader (SocketReader) : the buffered reader of the connection
+    Return:
+    (list): the evaluations as strings
+    '''
+    if reader.peek_short() == helper.V2_MARKER:
+        results = []
+        for expr in utils.read_expressions_v2(reader):
+            # a chunk is overwritten when the reader refills its buffer,
+            # so each one is copied before the next is read
+            data = bytearray()
+            for chunk in expr:
+                data += chunk
+            results.append(data.decode('utf8'))
+        return results
+    return [expr.decode('utf8') for expr in utils.read_expressions(reader)]
+
+class Connection:
+    '''
+    One connection to the server. Responses are read by their length
+    fields, so a response is never cut short or waited on past its end.
+    '''
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = utils.SocketReader(self.sock)
+
+    def send(self, messages):
+        '''
+        Send one request, using protocol v2 if v1 cannot carry it.
+        Params:
+        messages (list) : expressions as bytes
+        '''
+        if helper.needs_v2(messages):
+            self.sock.sendall(helper.format_v2(messages))
+        else:
+            self.sock.sendall(helper.format(messages))
+
+    def receive(self):
+        '''
+        Read one response.
+        Return:
+        (list): the evaluations as strings
+        '''
+        return read_response(self.reader)
+
+    def close(self):
+        self.sock.close()
+
+class ExpressionClient:
+    '''
+    Pooled, pipelining client. Connections are kept open between calls,
+    which needs the server running in async mode; a connection that fails
+    is dropped from the pool and a new one is opened on demand.
+    Params:
+    host (str) : server host
+    port (int) : server port
+    pool_size (int) : the most connections kept open
+    batch_size (int) : expressions per request in evaluate_many
+    pipeline_depth (int) : requests in flight per connection
+    '''
+
+    def __init__(self, host, port, pool_size=4, batch_size=1000, pipeline_depth=8, timeout=None):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.pipeline_depth = pipeline_depth
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.executor = ThreadPoolExecutor(pool_size)
+
+    def acquire(self):
+        '''
+        Take an idle connection from the pool or open a new one.
+        Return:
+        (tuple): the connection and whether it came from the pool
+        '''
+        try:
+            return (self.idle.get_nowait(), True)
+        except queue.Empty:
+            return (Connection(self.host, self.port, self.timeout), False)
+
+    def release(self, conn):
+        '''
+        Put a healthy connection back into the pool.
+        '''
+        if self.idle.qsize() < self.pool_size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+    def evaluate(self, expressions):
+        '''
+        Evaluate one batch of expressions in a single round trip.
+        Params:
+        expressions (list) : expressions as strings
+        Return:
+        (list): the evaluations as strings
+        '''
+        return self.run_batches([[expr.encode('utf8') for expr in expressions]])[0]
+
+    def evaluate_many(self, expressions):
+        '''
+        Evaluate any number of expressions. They are cut into batches of
+        batch_size, spread over up to pool_size connections and pipelined
+        on each of them.
+        Params:
+        expressions (list) : expressions as strings
+        Return:
+        (list): the evaluations as strings, in the order of expressions
+        '''
+        messages = [expr.encode('utf8') for expr in expressions]
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        if not batches:
+            return []
+        # every connection gets an interleaved share of the batches
+        shares = [batches[i::self.pool_size] for i in range(min(self.pool_size, len(batches)))]
+        share_results = list(self.executor.map(self.run_batches, shares))
+        results = []
+        for i in range(len(batches)):
+            results.extend(share_results[i % len(shares)][i // len(shares)])
+        return results
+
+    def run_batches(self, batches):
+        '''
+        Send the batches on one connection, keeping up to pipeline_depth of
+        them in flight, and read the responses in order. A pooled connection
+        the server closed while idle is replaced by a fresh one.
+        Params:
+        batches (list) : a list of requests, each a list of bytes
+        Return:
+        (list): one list of evaluations per batch
+        '''
+        while True:
+            conn, reused = self.acquire()
+            try:
+                return self.run_batches_on(conn, batches)
+            except OSError:
+                # evaluation has no side effects, so resending is safe
+                if not reused:
+                    raise
+
+    def run_batches_on(self, conn, batches):
+        '''
+        Pipeline the batches on the given connection.
+        '''
+        window = threading.Semaphore(self.pipeline_depth)
+        failure = []
+
+        def send_all():
+            try:
+                for batch in batches:
+                    window.acquire()
+                    conn.send(batch)
+            except OSError as e:
+                failure.append(e)
+
+        # sending on its own thread means a full socket buffer on either
+        # side can never deadlock the pipeline
+        sender = threading.Thread(target=send_all)
+        sender.start()
+        results = []
+        try:
+            for batch in batches:
+                results.append(conn.receive())
+                window.release()
+        except BaseException:
+            # a failed read, a malformed response or an interrupt: the
+            # connection cannot be reused, and the sender is unblocked so it
+            # can see the closed socket and stop
+            conn.close()
+            for batch in batches:
+                window.release()
+            sender.join()
+            raise
+        sender.join()
+        if failure:
+            conn.close()
+            raise failure[0]
+        self.release(conn)
+        return results
+
+    def close(self):
+        '''
+        Close every pooled connection.
+        '''
+        self.executor.shutdown()
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
@@ -4,6 +4,30 @@
 
 import struct
 
+########################################################################
+#                          Protocol versions                           #
+#    v1: count '!h', then per message length '!h' and the bytes.       #
+#        Up to 32767 messages of up to 32767 bytes each.               #
+#    v2: the marker -2 as '!h' (never a valid v1 count), then count    #
+#        '!I', then per message length '!I' and the bytes.             #
+#    A v2 request is answered with a v2 response, so a client opts in  #
+#    per request and the server keeps serving v1 clients unchanged.    #
+########################################################################
+
+V2_MARKER = -2
+
+# the largest count or length a v1 '!h' field can hold
+V1_MAX = 32767
+
+# precompiled codecs of the count and length fields
+short_struct = struct.Struct('!h')
+uint_struct = struct.Struct('!I')
+v2_head_struct = struct.Struct('!hI')
+
+# RequestParser payloads at least this long are fed to a stream object as
+# they arrive instead of being buffered whole
+stream_min = 64 * 1024
+
 def parse(data):
     '''
     Parse the bytes data into a list of expressions strings, using Big Endian.
@@ -13,18 +37,19 @@ def parse(data):
     (list): expressions in string format as a list.
     '''
     expressions = []
-    offset = 0
+    unpack_from = short_struct.unpack_from
+    data = memoryview(data)
     # get first 2 bytes
-    expressionsNum = int(struct.unpack_from('!h', data, offset)[0])
-    offset += 2
+    (expressionsNum,) = unpack_from(data, 0)
+    offset = 2
     for i in range(expressionsNum):
         # read next 2 bytes and get current expression length
-        curr_expression_len = int(struct.unpack_from('!h', data, offset)[0])
+        (curr_expression_len,) = unpack_from(data, offset)
         offset += 2
         # read the next length of bytes
-        curr_expression = struct.unpack_from('!' + str(curr_expression_len) + 's', data, offset)[0]
+        curr_expression = data[offset:offset + curr_expression_len]
         offset += curr_expression_len
-        expressions.append(curr_expression.decode('utf8'))
+        expressions.append(str(curr_expression, 'utf8'))
     # return the result
     return expressions
 
@@ -35,23 +60,25 @@ def format(messages):
     Params:
     evaluatioins (list) : a list of messages as strings
     Return:
-    (str) : a better formatted message as bytes.
-    '''
-    messages_len = len(messages)
-    offset = 0
-    result_len = 2 + messages_len * 2 + bytes_list_length(messages)
-    result = bytearray(result_len)
-    # pack the num of evaluations into the response
-    struct.pack_into('!h', result, offset, messages_len)
-    offset += 2
+    (bytes) : a better formatted message as bytes.
+    '''
+    return b''.join(format_buffers(messages))
+
+def format_buffers(messages):
+    '''
+    Format the messages like format, but as the list of buffers that make up
+    the message, ready for one scatter-gather send without joining them.
+    Params:
+    messages (list) : a list of messages as bytes
+    Return:
+    (list) : the count field, then each length field and message in turn.
+    '''
+    pack = short_struct.pack
+    buffers = [pack(len(messages))]
     for message in messages:
-        curr_message_len = len(message)
-        # pack the current evaluation length into the response
-        struct.pack_into('!h', result, offset, curr_message_len)
-        offset += 2
-        struct.pack_into('!' + str(curr_message_len) + 's', result, offset, message)
-        offset += curr_message_len
-    return result
+        buffers.append(pack(len(message)))
+        buffers.append(message)
+    return buffers
 
 def bytes_list_length(bytes_list):
     '''
@@ -65,3 +92,180 @@ def bytes_list_length(bytes_list):
     for item in bytes_list:
         res += len(item)
     return res
+
+def parse_v2(data):
+    '''
+    Parse a v2 message into a list of expressions strings, using Big Endian.
+    Params:
+    data (bytes) : the data in bytes, starting with the v2 marker.
+    Return: 
+    (list): expressions in string format as a list.
+    '''
+    expressions = []
+    unpack_from = uint_struct.unpack_from
+    data = memoryview(data)
+    (marker, expressionsNum) = v2_head_struct.unpack_from(data, 0)
+    if marker != V2_MARKER:
+        raise ValueError('not a v2 message')
+    offset = v2_head_struct.size
+    for i in range(expressionsNum):
+        (curr_expression_len,) = unpack_from(data, offset)
+        offset += 4
+        curr_expression = data[offset:offset + curr_expression_len]
+        offset += curr_expression_len
+        expressions.append(str(curr_expression, 'utf8'))
+    return expressions
+
+def format_v2(messages):
+    ''' 
+    Format the messages in the given list into a v2 message, using Big Endian.
+    Params:
+    messages (list) : a list of messages as bytes
+    Return:
+    (bytes) : the v2 message as bytes.
+    '''
+    return b''.join(format_v2_buffers(messages))
+
+def format_v2_buffers(messages):
+    '''
+    Format the messages like format_v2, as a list of buffers.
+    Params:
+    messages (list) : a list of messages as bytes
+    Return:
+    (list) : the head, then each length field and message in turn.
+    '''
+    pack = uint_struct.pack
+    buffers = [v2_head_struct.pack(V2_MARKER, len(messages))]
+    for message in messages:
+        buffers.append(pack(len(message)))
+        buffers.append(message)
+    return buffers
+
+def needs_v2(messages):
+    '''
+    Check whether the messages are too many or too long for v1.
+    Params:
+    messages (list) : a list of messages as bytes
+    Return:
+    (bool) : True if only v2 can carry the messages.
+    '''
+    return len(messages) > V1_MAX or any(len(message) > V1_MAX for message in messages)
+
+class RequestParser:
+    '''
+    Push-style parser of v1 and v2 requests for non-blocking sockets. Feed
+    it byte chunks of any size as they arrive; it calls on_expression with
+    every expression as soon as its last byte is in, and on_request with
+    the protocol version once a whole request has been seen. Partial
+    fields are kept between calls. Given a stream factory, payloads of at
+    least stream_min bytes are not buffered: each gets a new stream object
+    which is fed the payload piece by piece and then passed to
+    on_expression in place of the bytes, so memory stays constant however
+    long a v2 expression is.
+    Params:
+    on_expression (function) : called with each expression as bytes, or
+    with its stream object
+    on_request (function) : called with 1 or 2 at the end of each request
+    stream (function) : makes an object with a feed(chunk) method, or None
+    stream_min (int) : the shortest payload streamed
+    '''
+
+    # what the next field is
+    HEAD, COUNT, LENGTH, PAYLOAD = range(4)
+
+    def __init__(self, on_expression, on_request, stream=None, stream_min=stream_min):
+        self.on_expression = on_expression
+        self.on_request = on_request
+        self.stream = stream
+        self.stream_min = stream_min
+        # the stream object of the payload being read, if it is streamed
+        self.streaming = None
+        self.state = self.HEAD
+        self.need = 2
+        self.pending = bytearray()
+        self.version = 1
+        self.remaining = 0
+
+    def feed(self, data):
+        '''
+        Parse the next chunk of the stream.
+        Params:
+        data (bytes) : the bytes received
+        '''
+        data = memoryview(data)
+        pos, size = 0, len(data)
+        while pos < size:
+            if self.streaming is not None:
+                take = min(self.need, size - pos)
+                self.streaming.feed(data[pos:pos + take])
+                pos += take
+                self.need -= take
+                if self.need == 0:
+                    (streaming, self.streaming) = (self.streaming, None)
+                    self.end_expression(streaming)
+                continue
+            take = min(self.need - len(self.pending), size - pos)
+            if not self.pending and take == self.need:
+                # the whole field is in this chunk, no copy needed
+                field = data[pos:pos + take]
+                pos += take
+            else:
+                self.pending += data[pos:pos + take]
+                pos += take
+                if len(self.pending) < self.need:
+                    return
+                field = self.pending
+                self.pending = bytearray()
+            self.advance(field)
+
+    def advance(self, field):
+        '''
+        Consume one complete field and move to the next state.
+        '''
+        if self.state == self.HEAD:
+            (head,) = short_struct.unpack(field)
+            if head == V2_MARKER:
+                self.version = 2
+                self.expect(self.COUNT, 4)
+            elif head < 0:
+                raise ValueError('invalid expression count ' + str(head))
+            else:
+                self.version = 1
+                self.start_request(head)
+        elif self.state == self.COUNT:
+            self.start_request(uint_struct.unpack(field)[0])
+        elif self.state == self.LENGTH:
+            length = (short_struct if self.version == 1 else uint_struct).unpack(field)[0]
+            if length < 0:
+                raise ValueError('invalid expression length ' + str(length))
+            if length == 0:
+                self.end_expression(b'')
+            else:
+                if self.stream is not None and length >= self.stream_min:
+                    self.streaming = self.stream()
+                self.expect(self.PAYLOAD, length)
+        else:
+            self.end_expression(bytes(field))
+
+    def expect(self, state, need):
+        self.state = state
+        self.need = need
+
+    def start_request(self, count):
+        self.remaining = count
+        if count == 0:
+            self.end_request()
+        else:
+            self.expect(self.LENGTH, 2 if self.version == 1 else 4)
+
+    def end_expression(self, expression):
+        self.on_expression(expression)
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.end_request()
+        else:
+            self.expect(self.LENGTH, 2 if self.version == 1 else 4)
+
+    def end_request(self):
+        self.expect(self.HEAD, 2)
+        self.on_request(self.version)
@@ -0,0 +1,141 @@
+# Load generator for the expression server
+# Auther: Yuanjie Yuanjie
+# Date: 09/25/19
+
+import argparse
+import json
+import math
+import random
+import socket
+import threading
+import time
+import expression_client
+
+def make_expression(rng, length):
+    '''
+    Build a random '+' '-' expression of about the given length.
+    Params:
+    rng (random.Random) : the random source
+    length (int) : the length in bytes
+    Return:
+    (bytes): the expression
+    '''
+    parts = [str(rng.randint(0, 999))]
+    size = len(parts[0])
+    while size < length:
+        term = rng.choice('+-') + str(rng.randint(0, 999))
+        parts.append(term)
+        size += len(term)
+    return ''.join(parts).encode('utf8')
+
+def percentile(sorted_values, p):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    Params:
+    sorted_values (list) : the values in ascending order
+    p (float) : the percentile, between 0 and 100
+    '''
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+def worker(args, seed, deadline, latencies, errors):
+    '''
+    Drive one connection in a closed loop until the deadline, recording the
+    latency of every request.
+    '''
+    rng = random.Random(seed)
+    # a fixed pool of requests per worker keeps runs repeatable
+    requests = [[make_expression(rng, args.expr_len) for i in range(args.batch)] for j in range(16)]
+    conn = None
+    i = 0
+    while time.perf_counter() < deadline:
+        batch = requests[i % len(requests)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = expression_client.Connection(args.host, args.port, args.timeout)
+            conn.send(batch)
+            conn.receive()
+        except OSError:
+            errors.append(1)
+            if conn is not None:
+                conn.close()
+            conn = None
+            # back off instead of spinning while the server is unreachable
+            time.sleep(0.01)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if not args.reuse:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+def run(args):
+    '''
+    Run the load and return the results as a dict.
+    '''
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    workers = [threading.Thread(target=worker, args=(args, args.seed + i, deadline, latencies, errors))
+               for i in range(args.connections)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'label': args.label,
+        'host': args.host,
+        'port': args.port,
+        'connections': args.connections,
+        'batch': args.batch,
+        'expr_len': args.expr_len,
+        'reuse': args.reuse,
+        'duration_s': elapsed,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_s': len(latencies) / elapsed,
+        'expressions_per_s': len(latencies) * args.batch / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1e3,
+            'p99': percentile(latencies, 99) * 1e3,
+            'p999': percentile(latencies, 99.9) * 1e3,
+            'max': (latencies[-1] if latencies else 0.0) * 1e3,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the expression server.')
+    parser.add_argument('--host', default=socket.getfqdn())
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('-c', '--connections', type=int, default=8, help='concurrent connections')
+    parser.add_argument('-b', '--batch', type=int, default=10, help='expressions per request')
+    parser.add_argument('-l', '--expr-len', type=int, default=32, help='bytes per expression')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds to run')
+    parser.add_argument('--reuse', action='store_true',
+                        help='keep connections open between requests (server in async mode)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='socket timeout in seconds')
+    parser.add_argument('--seed', type=int, default=5700, help='seed of the generated expressions')
+    parser.add_argument('--label', default='', help='name of the run, e.g. the server mode')
+    parser.add_argument('-o', '--output', help='append the results as one JSON line to this file')
+    args = parser.parse_args()
+
+    result = run(args)
+    latency = result['latency_ms']
+    print(f"{result['requests']} requests in {result['duration_s']:.2f}s, {result['errors']} errors")
+    print(f"{result['requests_per_s']:.1f} requests/s, {result['expressions_per_s']:.1f} expressions/s")
+    print(f"latency p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms, "
+          f"p999 {latency['p999']:.3f} ms, max {latency['max']:.3f} ms")
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,41 @@
 # Auther: Yuanjie Yuanjie
 # Date: 09/25/19
 
+import asyncio
+import queue
+import selectors
+import signal
 import socket
+import sys
 import threading
 import time
+from collections import deque
+import evaluator
 import helper
 import utils
 
+# 'thread' serves one request per connection on its own thread,
+# 'async' keeps connections open and answers pipelined requests in order,
+# 'select' does the same on a selectors loop driving RequestParser.
+# A process count moves evaluation of large requests to that many workers.
+if len(sys.argv) > 3 or (len(sys.argv) > 1 and sys.argv[1] not in ['thread', 'async', 'select']) \
+        or (len(sys.argv) == 3 and not sys.argv[2].isdigit()):
+    print('Usage: python server.py [thread|async|select] [processes]')
+    sys.exit(1)
+mode = sys.argv[1] if len(sys.argv) > 1 else 'thread'
+processes = int(sys.argv[2]) if len(sys.argv) == 3 else 0
+
+backend = evaluator.ProcessBackend(processes) if processes > 0 else None
+
+def stop(signum, frame):
+    '''
+    Exit on SIGTERM like on Ctrl-C, unwinding the main thread so the worker
+    processes are shut down rather than left behind.
+    '''
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, stop)
+
 host_name = socket.getfqdn()
 print('hostname is', host_name)
 
@@ -17,6 +46,8 @@ print('host IP address is', host_ip)
 host_port = 8181
 
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# allow restarting right away, e.g. between benchmark runs
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 s.bind((host_ip, host_port))
 s.listen()
 print('Server started. Waiting for connection...')
@@ -31,13 +62,17 @@ def now():
 bufsize = 16
 
 def handler(conn, addr):
-    exprs = utils.read_expressions(conn)
-    print('Server received', len(exprs), 'expressions from', addr)
-    resp = []
-    for expr in exprs:
-        print('expression', expr)
-        resp.append(str(eval(expr)).encode('utf8'))
-    utils.write_expressions(conn, resp)
+    reader = utils.SocketReader(conn)
+    if reader.peek_short() == helper.V2_MARKER:
+        # v2 expressions are evaluated while they stream in
+        resp = [evaluator.evaluate_stream(expr) for expr in utils.read_expressions_v2(reader)]
+        print('Server received', len(resp), 'v2 expressions from', addr)
+        utils.write_expressions_v2(conn, resp)
+    else:
+        exprs = utils.read_expressions(reader)
+        print('Server received', len(exprs), 'expressions from', addr)
+        resp = backend.evaluate(exprs) if backend else evaluator.evaluate_batch(exprs)
+        utils.write_expressions(conn, resp)
     conn.close()
 
 def handler1(conn, addr):
@@ -60,7 +95,7 @@ def handler1(conn, addr):
     expressions = helper.parse(data)
     print('Parsed expressions are: ', expressions)
     # get all the evaluations of the expressions
-    evaluations = evaluate_expressions(expressions)
+    evaluations = evaluator.evaluate_expressions(expressions)
     # format the evaluations following the Response Format
     response = helper.format(evaluations)
     # send the organized the response to the client
@@ -68,43 +103,240 @@ def handler1(conn, addr):
     print ('Server sent response:', response, 'to', addr)
     conn.close()
 
-def evaluate_expressions(expressions):
+async def async_handler(reader, writer):
     '''
-    Evaluate the expressions in the given list.
+    Handles a client with asyncio streams, answering every request sent on
+    the connection in order until the client closes it.
     Params:
-    expressions (list) : a list of expressions string.
-    Return:
-    (list) : a list of evaluations bytes.
+    reader (asyncio.StreamReader) : the read side of the connection
+    writer (asyncio.StreamWriter) : the write side of the connection
+    '''
+    addr = writer.get_extra_info('peername')
+    print('Server connected by', addr, 'at', now())
+    try:
+        while True:
+            head = await utils.async_read_head(reader)
+            if head is None:
+                break
+            if head == helper.V2_MARKER:
+                evaluations = []
+                for i in range(await utils.async_read_uint(reader)):
+                    stream_evaluator = evaluator.StreamEvaluator()
+                    expr_len = await utils.async_read_uint(reader)
+                    await utils.async_stream(reader, expr_len, stream_evaluator.feed)
+                    evaluations.append(stream_evaluator.result())
+                writer.write(helper.format_v2(evaluations))
+            else:
+                exprs = await utils.async_read_expressions(reader, head)
+                if backend:
+                    evaluations = await backend.evaluate_async(exprs)
+                else:
+                    evaluations = evaluator.evaluate_batch(exprs)
+                writer.write(helper.format(evaluations))
+            # returns at once unless the client stopped reading responses
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_async():
     '''
-    return [evaluate_expression(expression).encode('utf8') for expression in expressions]
+    Serve clients on the listening socket with asyncio.
+    '''
+    server = await asyncio.start_server(async_handler, sock=s)
+    async with server:
+        await server.serve_forever()
+
+# stop reading from a client once this many response bytes wait for it
+select_out_max = 1024 * 1024
+# or once this many of its requests are being evaluated by the backend
+select_pending_max = 64
+# a request is kept until its last expression is in, so a client sending
+# more expressions or buffered bytes in one request is disconnected; longer
+# expressions are streamed and count only once each
+select_request_max = 64 * 1024
+select_request_max_bytes = 16 * 1024 * 1024
 
-def evaluate_expression(expression):
+class SelectConnection:
     '''
-    Evaluate an expression.
+    State of one client of the selectors loop: the parser, the expressions
+    of the request being read, the requests not answered yet and the
+    response bytes not sent yet. With a backend, requests are evaluated by
+    the worker processes while the loop goes on, and are answered in the
+    order they were sent.
     Params:
-    expression (str) : an expression that contains '+' '-'
-    Return:
-    (str) : the evaluation as a string.
+    conn (socket) : the non-blocking socket of the client
+    addr: the address of the client
+    post (function) : runs a function on the loop thread, called from
+    other threads
+    '''
+
+    def __init__(self, conn, addr, post):
+        self.conn = conn
+        self.addr = addr
+        self.post = post
+        self.exprs = []
+        self.exprs_bytes = 0
+        # [version, evaluations or None until they are ready] per request
+        self.responses = deque()
+        self.closed = False
+        self.out = bytearray()
+        # long v2 expressions are evaluated as they arrive, not buffered
+        self.parser = helper.RequestParser(self.add_expression, self.end_request, evaluator.StreamEvaluator)
+
+    def add_expression(self, expr):
+        '''
+        Keep an expression of the request being read, bytes or its
+        StreamEvaluator.
+        Raise:
+        ValueError: the request outgrew select_request_max or
+        select_request_max_bytes
+        '''
+        self.exprs.append(expr)
+        if isinstance(expr, bytes):
+            self.exprs_bytes += len(expr)
+        if len(self.exprs) > select_request_max or self.exprs_bytes > select_request_max_bytes:
+            raise ValueError('request too large')
+
+    def end_request(self, version):
+        '''
+        Evaluate the request just parsed and queue its response.
+        '''
+        exprs = self.exprs[:]
+        self.exprs.clear()
+        self.exprs_bytes = 0
+        response = [version, None]
+        self.responses.append(response)
+
+        def complete(results):
+            results = iter(results)
+            # streamed expressions come as their StreamEvaluator
+            response[1] = [next(results) if isinstance(expr, bytes) else expr.result() for expr in exprs]
+            self.flush()
+
+        buffered = [expr for expr in exprs if isinstance(expr, bytes)]
+        if not backend:
+            complete(evaluator.evaluate_batch(buffered))
+            return
+        future = backend.submit(buffered)
+        if future.done():
+            complete(future.result())
+        else:
+            future.add_done_callback(lambda future: self.post(self, lambda: complete(future.result())))
+
+    def flush(self):
+        '''
+        Move the responses that are ready, in order, to the output.
+        '''
+        while self.responses and self.responses[0][1] is not None:
+            (version, evaluations) = self.responses.popleft()
+            if version == 2:
+                self.out += helper.format_v2(evaluations)
+            else:
+                self.out += helper.format(evaluations)
+
+    def events(self):
+        '''
+        Return the events to wait for: reading pauses while too much of the
+        response is still waiting for the client.
+        '''
+        events = selectors.EVENT_WRITE if self.out else 0
+        if len(self.out) < select_out_max and len(self.responses) < select_pending_max:
+            events |= selectors.EVENT_READ
+        return events
+
+def serve_select():
+    '''
+    Serve every client from one thread with a selectors loop.
     '''
-    # return str(eval(expression))
-    
-    items = list(expression.strip())
-    i, nums = 0, len(items)
-    val, sign, curr_val = 0, 1, 0
-    while i < nums:
-        curr = items[i]
-        if curr.isdigit():
-            curr_val = curr_val * 10 + int(curr)
-        if curr in '+-' or i == nums - 1:
-            val += sign * curr_val
-            sign = 1 if curr == '+' else -1
-            curr_val = 0
-        i += 1
-    return str(val)
+    sel = selectors.DefaultSelector()
+    s.setblocking(False)
+    sel.register(s, selectors.EVENT_READ)
+    # functions posted by the backend's threads, and a socket pair waking
+    # the loop to run them
+    done = queue.SimpleQueue()
+    (wake_r, wake_w) = socket.socketpair()
+    wake_r.setblocking(False)
+    sel.register(wake_r, selectors.EVENT_READ)
+
+    def post(client, function):
+        done.put((client, function))
+        wake_w.send(b'x')
+
+    def close(client):
+        sel.unregister(client.conn)
+        client.conn.close()
+        client.closed = True
+
+    def update(client, events):
+        # flush what can be sent and wait for the events the client needs
+        try:
+            if client.out:
+                sent = client.conn.send(client.out)
+                del client.out[:sent]
+        except BlockingIOError:
+            pass
+        except ConnectionError:
+            close(client)
+            return
+        if client.events() != events:
+            sel.modify(client.conn, client.events(), client)
+
+    while True:
+        for key, events in sel.select():
+            if key.fileobj is s:
+                try:
+                    conn, addr = s.accept()
+                except BlockingIOError:
+                    continue
+                print('Server connected by', addr, 'at', now())
+                conn.setblocking(False)
+                sel.register(conn, selectors.EVENT_READ, SelectConnection(conn, addr, post))
+                continue
+            if key.fileobj is wake_r:
+                try:
+                    wake_r.recv(4096)
+                except BlockingIOError:
+                    pass
+                while not done.empty():
+                    (client, function) = done.get()
+                    if client.closed:
+                        continue
+                    try:
+                        function()
+                    except Exception as e:
+                        print('Evaluation failed for', client.addr, e)
+                        close(client)
+                        continue
+                    update(client, sel.get_key(client.conn).events)
+                continue
+            client = key.data
+            if events & selectors.EVENT_READ:
+                try:
+                    data = client.conn.recv(utils.reader_bufsize)
+                    if not data:
+                        close(client)
+                        continue
+                    client.parser.feed(data)
+                except BlockingIOError:
+                    pass
+                except (ConnectionError, ValueError):
+                    close(client)
+                    continue
+            update(client, key.events)
 
 # main thread
-while True:
-    conn, addr = s.accept()
-    print('Server connected by', addr, 'at', now())
-    threading.Thread(target=handler, args=(conn, addr)).start()
+try:
+    if mode == 'async':
+        asyncio.run(serve_async())
+    if mode == 'select':
+        serve_select()
+    while True:
+        conn, addr = s.accept()
+        print('Server connected by', addr, 'at', now())
+        threading.Thread(target=handler, args=(conn, addr)).start()
+finally:
+    if backend:
+        backend.close()
 
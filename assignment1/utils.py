@@ -2,29 +2,265 @@
 # Auther: Yuanjie Yuanjie
 # Date: 09/25/19
 
-import struct
+import asyncio
+import os
+import helper
 
-bufsize = 16
+# default capacity of a SocketReader buffer, grown on demand for larger frames
+reader_bufsize = 64 * 1024
+
+frame_len = helper.short_struct
+frame_len_v2 = helper.uint_struct
+
+# the most buffers one sendmsg call accepts
+try:
+    iov_max = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    iov_max = 1024
+
+class SocketReader:
+    '''
+    Buffered reader over a socket. It fills one preallocated buffer with
+    recv_into and hands out memoryview slices of it, so a frame costs no
+    copy and usually no extra syscall.
+    A returned view is only valid until the next read on the same reader;
+    copy it with bytes() to keep it.
+    '''
+
+    def __init__(self, conn, size=reader_bufsize):
+        self.conn = conn
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # unread bytes are buf[start:end]
+        self.start = 0
+        self.end = 0
+
+    def buffered(self):
+        '''
+        Return the number of bytes already received but not read yet.
+        '''
+        return self.end - self.start
+
+    def fill(self, n):
+        '''
+        Make sure at least n unread bytes are in the buffer.
+        Params:
+        n (int) : the number of bytes needed
+        '''
+        if self.end - self.start >= n:
+            return
+        if self.start + n > len(self.buf):
+            # move the unread tail to the front, growing the buffer if the
+            # frame does not fit at all
+            pending = self.end - self.start
+            if n > len(self.buf):
+                buf = bytearray(max(n, 2 * len(self.buf)))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        while self.end - self.start < n:
+            received = self.conn.recv_into(self.view[self.end:])
+            if received == 0:
+                raise ConnectionError('connection closed by peer')
+            self.end += received
+
+    def read(self, n):
+        '''
+        Read exactly n bytes.
+        Params:
+        n (int) : the number of bytes to read
+        Return:
+        (memoryview): the bytes, valid until the next read
+        '''
+        self.fill(n)
+        data = self.view[self.start:self.start + n]
+        self.start += n
+        return data
+
+    def read_short(self):
+        '''
+        Read one '!h' field.
+        Return:
+        (int): the value of the field
+        '''
+        self.fill(2)
+        (value,) = frame_len.unpack_from(self.buf, self.start)
+        self.start += 2
+        return value
+
+    def peek_short(self):
+        '''
+        Return the next '!h' field without consuming it.
+        '''
+        self.fill(2)
+        return frame_len.unpack_from(self.buf, self.start)[0]
+
+    def read_uint(self):
+        '''
+        Read one '!I' field.
+        Return:
+        (int): the value of the field
+        '''
+        self.fill(4)
+        (value,) = frame_len_v2.unpack_from(self.buf, self.start)
+        self.start += 4
+        return value
+
+    def stream(self, n):
+        '''
+        Read exactly n bytes as a series of chunks no larger than the buffer,
+        so a frame of any length is read in constant memory.
+        Params:
+        n (int) : the number of bytes to read
+        Return:
+        (generator): memoryview chunks, each valid until the next one
+        '''
+        while n > 0:
+            if self.start == self.end:
+                self.start = self.end = 0
+                self.fill(1)
+            take = min(n, self.end - self.start)
+            chunk = self.view[self.start:self.start + take]
+            self.start += take
+            n -= take
+            yield chunk
+
+    def read_frame(self):
+        '''
+        Read one '!h' length-prefixed frame.
+        Return:
+        (memoryview): the payload of the frame, valid until the next read
+        '''
+        return self.read(self.read_short())
 
 def read_n_bytes(conn, n):
-    data = bytearray()
-    while len(data) < n:
-        remain_bytes = n - len(data)
-        read_len = min(bufsize, remain_bytes)
-        data += conn.recv(read_len)
+    '''
+    Read exactly n bytes from the socket into a preallocated buffer.
+    Params:
+    conn (socket) : the socket
+    n (int) : the number of bytes to read
+    Return:
+    (bytearray): the bytes read
+    '''
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        curr_len = conn.recv_into(view[received:])
+        if curr_len == 0:
+            raise ConnectionError('connection closed by peer')
+        received += curr_len
     return data
 
-def read_expressions(conn):
+def read_expressions(reader):
+    '''
+    Read one count-prefixed request.
+    Params:
+    reader (SocketReader) : the buffered reader of the connection
+    Return:
+    (list): expressions as bytes
+    '''
     exprs = []
-    (exprs_num,) = struct.unpack('!h', read_n_bytes(conn, 2))
+    exprs_num = reader.read_short()
     for i in range(exprs_num):
-        (expr_len,) = struct.unpack('!h', read_n_bytes(conn, 2))
-        expr = read_n_bytes(conn, expr_len)
-        exprs.append(expr)
+        exprs.append(bytes(reader.read_frame()))
     return exprs
 
+def send_buffers(conn, buffers):
+    '''
+    Send a list of buffers with as few sendmsg calls as possible, picking up
+    after partial sends.
+    Params:
+    conn (socket) : the socket
+    buffers (list) : the buffers, sent in order
+    '''
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(buffers))
+        return
+    i, count = 0, len(buffers)
+    while i < count:
+        sent = conn.sendmsg(buffers[i:i + iov_max])
+        # skip the buffers that went out whole and trim a partial one
+        while i < count and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        if sent:
+            buffers[i] = memoryview(buffers[i])[sent:]
+
 def write_expressions(conn, exprs):
-    conn.sendall(struct.pack('!h', len(exprs)))
-    for expr in exprs:
-        conn.sendall(struct.pack('!h', len(expr)))
-        conn.sendall(expr)
+    send_buffers(conn, helper.format_buffers(exprs))
+
+def read_expressions_v2(reader):
+    '''
+    Read one v2 request lazily. Each expression is handed out as a chunk
+    generator which must be used up before the next one is taken.
+    Params:
+    reader (SocketReader) : the buffered reader of the connection
+    Return:
+    (generator): one chunk generator per expression
+    '''
+    if reader.read_short() != helper.V2_MARKER:
+        raise ValueError('not a v2 request')
+    exprs_num = reader.read_uint()
+    for i in range(exprs_num):
+        yield reader.stream(reader.read_uint())
+
+def write_expressions_v2(conn, exprs):
+    send_buffers(conn, helper.format_v2_buffers(exprs))
+
+async def async_read_head(reader):
+    '''
+    Read the first '!h' field of a request from an asyncio stream: the
+    expression count of a v1 request or the marker of a v2 request.
+    Params:
+    reader (asyncio.StreamReader) : the stream of the connection
+    Return:
+    (int): the field, or None if the peer closed the connection before a
+    new request started.
+    '''
+    try:
+        head = await reader.readexactly(2)
+    except asyncio.IncompleteReadError:
+        return None
+    return frame_len.unpack(head)[0]
+
+async def async_read_expressions(reader, exprs_num):
+    '''
+    Read the expressions of a v1 request from an asyncio stream.
+    Params:
+    reader (asyncio.StreamReader) : the stream of the connection
+    exprs_num (int) : the count read by async_read_head
+    Return:
+    (list): expressions as bytes
+    '''
+    exprs = []
+    for i in range(exprs_num):
+        (expr_len,) = frame_len.unpack(await reader.readexactly(2))
+        expr = await reader.readexactly(expr_len)
+        exprs.append(expr)
+    return exprs
+
+async def async_read_uint(reader):
+    '''
+    Read one '!I' field from an asyncio stream.
+    '''
+    return frame_len_v2.unpack(await reader.readexactly(4))[0]
+
+async def async_stream(reader, n, callback):
+    '''
+    Read exactly n bytes from an asyncio stream, passing each chunk to the
+    callback as it arrives instead of buffering the whole frame.
+    Params:
+    reader (asyncio.StreamReader) : the stream of the connection
+    n (int) : the number of bytes to read
+    callback (function) : called with every chunk
+    '''
+    while n > 0:
+        chunk = await reader.read(min(n, reader_bufsize))
+        if not chunk:
+            raise ConnectionError('connection closed by peer')
+        n -= len(chunk)
+        callback(chunk)
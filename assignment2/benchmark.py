@@ -0,0 +1,138 @@
+# HTTP Server Benchmark
+# Author: Yuanjie Yue
+# Date: 10/03/19
+# Usage: python benchmark.py [requests] [threads] [burst]
+# Run against httpserver.py in either mode; compares a new connection per
+# request with keep-alive and pipelined requests on persistent connections,
+# then opens a burst of simultaneous connections.
+
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+server = '127.0.0.1'
+port = 8181
+
+requests = [
+    b'GET /api/gettime HTTP/1.1\r\n\r\n',
+    b'POST /api/evalexpression HTTP/1.1\r\nContent-Length: 15\r\n\r\n12122+1111-2121',
+]
+
+# status code -> responses of the running measurement
+statuses = Counter()
+statuses_lock = threading.Lock()
+
+def read_response(f):
+    '''
+    Read one response from the file of a socket, framed by Content-Length.
+    Param
+    f: file object of the socket
+    Return
+    (bytes): the status line
+    '''
+    status = f.readline()
+    if not status:
+        raise ConnectionError('connection closed by server')
+    length = 0
+    while True:
+        line = f.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    f.read(length)
+    return status
+
+def count_statuses(codes):
+    '''
+    Add the status codes a worker saw to those of the measurement.
+    '''
+    with statuses_lock:
+        statuses.update(codes)
+
+def run_new_connections(count):
+    codes = Counter()
+    for i in range(count):
+        s = socket.create_connection((server, port))
+        req = requests[i % len(requests)].replace(b'\r\n\r\n', b'\r\nConnection: close\r\n\r\n', 1)
+        s.sendall(req)
+        codes[read_response(s.makefile('rb')).split()[1]] += 1
+        s.close()
+    count_statuses(codes)
+
+def run_keep_alive(count):
+    codes = Counter()
+    s = socket.create_connection((server, port))
+    f = s.makefile('rb')
+    for i in range(count):
+        s.sendall(requests[i % len(requests)])
+        codes[read_response(f).split()[1]] += 1
+    s.close()
+    count_statuses(codes)
+
+def run_pipelined(count):
+    s = socket.create_connection((server, port))
+    f = s.makefile('rb')
+    # keep a window of requests in flight on the one connection
+    window = 16
+    sent = 0
+    codes = Counter()
+    for i in range(count):
+        while sent < count and sent < i + window:
+            s.sendall(requests[sent % len(requests)])
+            sent += 1
+        codes[read_response(f).split()[1]] += 1
+    s.close()
+    count_statuses(codes)
+
+def measure(name, run, count, threads):
+    workers = [threading.Thread(target=run, args=(count // threads,)) for i in range(threads)]
+    statuses.clear()
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    print(f'{name:>16}: {count // threads * threads / elapsed:10.1f} requests/s')
+    # refused responses are cheap and would pass for throughput
+    others = {code.decode(): n for code, n in sorted(statuses.items()) if code != b'200'}
+    if others:
+        print(f'{"":>16}  not 200: {others}')
+        if b'429' in statuses:
+            print(f'{"":>16}  rate limited, set RATE_LIMIT = 0 in utils.py to load test from one machine')
+
+def burst(connections):
+    '''
+    Open many connections at once, send a request on each while all of them
+    are open, then read every response.
+    '''
+    start = time.perf_counter()
+    socks = []
+    failed = 0
+    for i in range(connections):
+        try:
+            socks.append(socket.create_connection((server, port), timeout=30))
+        except OSError:
+            failed += 1
+    for sock in socks:
+        sock.sendall(requests[0])
+    for sock in socks:
+        try:
+            read_response(sock.makefile('rb'))
+        except OSError:
+            failed += 1
+        sock.close()
+    elapsed = time.perf_counter() - start
+    print(f'{"burst":>16}: {connections} connections in {elapsed:.2f}s, {failed} failed')
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    measure('new connection', run_new_connections, count, threads)
+    measure('keep-alive', run_keep_alive, count, threads)
+    measure('pipelined', run_pipelined, count, threads)
+    burst(int(sys.argv[3]) if len(sys.argv) > 3 else 500)
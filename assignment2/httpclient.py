@@ -1,46 +1,278 @@
-# HTTP Server
+# HTTP load tester
 # Author: Yuanjie Yue
 # Date: 10/03/19
 
+import argparse
+import json
+import math
+import random
 import socket
+import threading
 import time
+from collections import defaultdict
 
-request1 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 8\r\n\r\n12345678'
-request2 = 'GET /api/gettime HTTP/1.1\r\n\r\n'
-request3 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 6\r\n\r\n11+2-3'
-request4 = 'GET /api/gettime HTTP/1.1\r\n\r\n'
-request5 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 15\r\n\r\n12122+1111-2121'
-request6 = 'GET /api/gettime HTTP/1.1\r\n\r\n'
-request7 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 399\r\n\r\n1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1+1'
-request8 = 'GET /api/gettime HTTP/1.1\r\n\r\n'
-request9 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 1999\r\n\r\n2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2+2'
-request10 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 4\r\n\r\n2*23'
-request11 = 'GET /api/gettime HTTP/1.1\r\n\r\n'
-request12 = 'POST /api/evalexpression HTTP/1.0\r\nContent-Length: 1\r\n\r\na'
-request13 = 'GET /api/gettime HTTP/1.1\r\n\r\n'
-request14 = 'GET /api/index HTTP/1.1\r\n\r\n'
-request15 = 'GET /index.html HTTP/1.1\r\n\r\n'
-request16 = 'GET /status HTTP/1.1\r\n\r\n'
-
-reqs = [request1, request2, request3, request4,request5,request6,request7,request8,request9,request10,request11,request12,request13,request14,request15,request16]
-def run(req):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server = '127.0.0.1'
-    port = 8181
-
-    server_ip = socket.gethostbyname(server)
-    print(server_ip)
-
-    s.connect((server, port))
-
-    bufsize = 4096
-    print('----------------------------------------------')
-    print('client sent: ', req.encode('utf8'))
-    s.sendall(req.encode('utf8'))
-    result = s.recv(bufsize)
-    print('client received: ', result)
-    print('----------------------------------------------')
-
-for i in reqs:
-    run(i)
-    time.sleep(3)
+# name -> (method, path, body, expected status); bodies of the same length
+# are fixed so the evaluation cache treats every run alike. Any other status,
+# e.g. a 429 of the rate limit, counts as an error and not as a sample
+endpoints = {
+    'gettime': ('GET', '/api/gettime', None, 200),
+    'eval': ('POST', '/api/evalexpression', b'12122+1111-2121', 200),
+    'eval-long': ('POST', '/api/evalexpression', b'+'.join([b'2'] * 1000), 200),
+    'eval-invalid': ('POST', '/api/evalexpression', b'2*23', 400),
+    'status': ('GET', '/status', None, 200),
+    'metrics': ('GET', '/metrics', None, 200),
+    'missing': ('GET', '/index.html', None, 404),
+}
+
+default_mix = 'gettime=4,eval=4,eval-long=1,status=1'
+
+def parse_mix(mix):
+    '''
+    Parse an endpoint mix like 'gettime=4,eval=1'.
+    Param
+    mix: comma separated name=weight pairs, a bare name weighs 1
+    Return
+    (tuple): the endpoint names and their weights
+    '''
+    names, weights = [], []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in endpoints:
+            raise argparse.ArgumentTypeError(f'unknown endpoint {name}, choose from {", ".join(endpoints)}')
+        try:
+            weight = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'bad weight in {item}')
+        names.append(name)
+        weights.append(weight)
+    if sum(weights) <= 0:
+        raise argparse.ArgumentTypeError('the weights add up to nothing')
+    return (names, weights)
+
+def build_request(name, keep_alive):
+    '''
+    Encode the request of an endpoint.
+    Param
+    name: the endpoint name
+    keep_alive: whether to ask for the connection to stay open
+    Return
+    (bytes): the request
+    '''
+    (method, path, body, expected) = endpoints[name]
+    head = f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+    if not keep_alive:
+        head += 'Connection: close\r\n'
+    if body is not None:
+        head += f'Content-Length: {len(body)}\r\n'
+    return (head + '\r\n').encode('utf8') + (body or b'')
+
+def read_response(f):
+    '''
+    Read one response, framed by Content-Length or chunked encoding.
+    Param
+    f: file object of the socket
+    Return
+    (tuple): the status code and the body length
+    '''
+    status = f.readline()
+    if not status:
+        raise ConnectionError('connection closed by server')
+    code = int(status.split(b' ', 2)[1])
+    content_length = None
+    chunked = False
+    while True:
+        line = f.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            content_length = int(value)
+        elif name == b'transfer-encoding':
+            chunked = value.strip().lower() == b'chunked'
+    if chunked:
+        body_len = 0
+        while True:
+            size = int(f.readline().split(b';', 1)[0], 16)
+            if size == 0:
+                # skip the trailer up to its blank line
+                while f.readline() not in (b'\r\n', b''):
+                    pass
+                return (code, body_len)
+            body_len += len(f.read(size))
+            f.readline()
+    if content_length is None:
+        raise ConnectionError('response without Content-Length')
+    if len(f.read(content_length)) < content_length:
+        raise ConnectionError('connection closed by server')
+    return (code, content_length)
+
+def percentile(sorted_values, p):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    Param
+    sorted_values: the values in ascending order
+    p: the percentile, between 0 and 100
+    '''
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+class Worker:
+    '''
+    One connection driven in a closed loop: a request is sent once the
+    response to the previous one was read. The endpoints are drawn from
+    the mix with a seeded random source, so a run is repeatable.
+    '''
+
+    def __init__(self, args, names, weights, seed):
+        self.args = args
+        self.rng = random.Random(seed)
+        self.names = names
+        self.weights = weights
+        self.requests = {name: build_request(name, args.keep_alive) for name in names}
+        # endpoint -> latencies in seconds of the expected responses,
+        # endpoint -> status code -> count, and endpoint -> connection
+        # failures and unexpected statuses
+        self.latencies = defaultdict(list)
+        self.codes = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+
+    def run(self, warmup_end, deadline):
+        sock, f = None, None
+        sent = 0
+        while time.perf_counter() < deadline and (not self.args.requests or sent < self.args.requests):
+            name = self.rng.choices(self.names, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                if sock is None:
+                    sock = socket.create_connection((self.args.host, self.args.port), self.args.timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    f = sock.makefile('rb')
+                sock.sendall(self.requests[name])
+                (code, body_len) = read_response(f)
+            except (OSError, ValueError, IndexError):
+                if start >= warmup_end:
+                    self.errors[name] += 1
+                if sock is not None:
+                    sock.close()
+                sock = None
+                # back off instead of spinning while the server is unreachable
+                time.sleep(0.01)
+                continue
+            elapsed = time.perf_counter() - start
+            sent += 1
+            if start >= warmup_end:
+                self.codes[name][code] += 1
+                if code == endpoints[name][3]:
+                    self.latencies[name].append(elapsed)
+                else:
+                    self.errors[name] += 1
+            if not self.args.keep_alive:
+                sock.close()
+                sock = None
+        if sock is not None:
+            sock.close()
+
+def run(args):
+    '''
+    Run the load and return the results as a dict.
+    '''
+    (names, weights) = args.mix
+    workers = [Worker(args, names, weights, args.seed + i) for i in range(args.connections)]
+    start = time.perf_counter()
+    warmup_end = start + args.warmup
+    deadline = warmup_end + args.duration
+    threads = [threading.Thread(target=w.run, args=(warmup_end, deadline)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - max(start, warmup_end)
+    per_endpoint = {}
+    for name in names:
+        latencies = sorted(l for w in workers for l in w.latencies[name])
+        codes = defaultdict(int)
+        for w in workers:
+            for code, count in w.codes[name].items():
+                codes[code] += count
+        per_endpoint[name] = {
+            'requests': len(latencies),
+            'errors': sum(w.errors[name] for w in workers),
+            'codes': {str(code): count for code, count in sorted(codes.items())},
+            'requests_per_s': len(latencies) / elapsed,
+            'latency_ms': {
+                'p50': percentile(latencies, 50) * 1e3,
+                'p99': percentile(latencies, 99) * 1e3,
+                'p999': percentile(latencies, 99.9) * 1e3,
+                'max': (latencies[-1] if latencies else 0.0) * 1e3,
+            },
+        }
+    everything = sorted(l for w in workers for name in names for l in w.latencies[name])
+    codes = defaultdict(int)
+    for endpoint in per_endpoint.values():
+        for code, count in endpoint['codes'].items():
+            codes[code] += count
+    return {
+        'label': args.label,
+        'host': args.host,
+        'port': args.port,
+        'connections': args.connections,
+        'keep_alive': args.keep_alive,
+        'mix': dict(zip(names, weights)),
+        'seed': args.seed,
+        'duration_s': elapsed,
+        'requests': len(everything),
+        'errors': sum(e['errors'] for e in per_endpoint.values()),
+        'codes': dict(sorted(codes.items())),
+        'requests_per_s': len(everything) / elapsed,
+        'latency_ms': {
+            'p50': percentile(everything, 50) * 1e3,
+            'p99': percentile(everything, 99) * 1e3,
+            'p999': percentile(everything, 99.9) * 1e3,
+            'max': (everything[-1] if everything else 0.0) * 1e3,
+        },
+        'endpoints': per_endpoint,
+    }
+
+def print_row(name, result):
+    latency = result['latency_ms']
+    codes = ' '.join(f'{code}:{count}' for code, count in result['codes'].items())
+    print(f"{name:>14} {result['requests']:>9} {result['errors']:>7} {result['requests_per_s']:>10.1f} "
+          f"{latency['p50']:>9.3f} {latency['p99']:>9.3f} {latency['p999']:>9.3f} {latency['max']:>9.3f}  {codes}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tester for the HTTP server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('-c', '--connections', type=int, default=8, help='concurrent connections')
+    parser.add_argument('-m', '--mix', type=parse_mix, default=parse_mix(default_mix),
+                        help=f'weighted endpoints, e.g. {default_mix}; endpoints: {", ".join(endpoints)}')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds to measure')
+    parser.add_argument('-w', '--warmup', type=float, default=1.0, help='seconds to run before measuring')
+    parser.add_argument('-n', '--requests', type=int, default=0,
+                        help='stop each connection after this many requests, 0 for no limit')
+    parser.add_argument('--no-keep-alive', dest='keep_alive', action='store_false',
+                        help='open a new connection for every request')
+    parser.add_argument('--timeout', type=float, default=10.0, help='socket timeout in seconds')
+    parser.add_argument('--seed', type=int, default=5700, help='seed of the endpoint sequence')
+    parser.add_argument('--label', default='', help='name of the run, e.g. the server mode')
+    parser.add_argument('-o', '--output', help='append the results as one JSON line to this file')
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f"{result['requests']} requests in {result['duration_s']:.2f}s over {args.connections} connections, "
+          f"keep-alive {'on' if args.keep_alive else 'off'}")
+    print(f"{'endpoint':>14} {'requests':>9} {'errors':>7} {'req/s':>10} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'max ms':>9}  statuses")
+    for name, endpoint in result['endpoints'].items():
+        print_row(name, endpoint)
+    print_row('total', result)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+if __name__ == '__main__':
+    main()
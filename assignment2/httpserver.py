@@ -2,10 +2,45 @@
 # Author: Yuanjie Yue
 # Date: 10/03/19
 
+import os
+import queue
+import selectors
+import signal
 import socket
+import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import utils
 
+# 'thread' starts a thread per connection, 'event' serves every connection
+# from one selectors loop and runs handlers on a bounded worker pool,
+# 'prefork' runs that many processes in thread mode on the same port
+if len(sys.argv) > 3 or (len(sys.argv) > 1 and sys.argv[1] not in ['thread', 'event', 'prefork']) \
+        or (len(sys.argv) == 3 and (sys.argv[1] != 'prefork' or not sys.argv[2].isdigit())):
+    print('Usage: python httpserver.py [thread|event|prefork] [workers]')
+    sys.exit(1)
+mode = sys.argv[1] if len(sys.argv) > 1 else 'thread'
+workers = int(sys.argv[2]) if len(sys.argv) == 3 else os.cpu_count()
+
+# event mode limits
+MAX_CONNECTIONS = 1024
+# a connection is not read from while this many received bytes wait in its
+# buffer, and its next request is not started while this many response
+# bytes wait to be sent, e.g. for a client pipelining without reading the
+# responses; the buffer holds any request that is not streamed
+MAX_BUFFERED = max(256 * 1024, utils.MAX_HEADER_SIZE + utils.STREAM_BODY_MIN)
+# handlers running at once, in every mode
+HANDLER_WORKERS = 16
+# requests waiting for a handler at most and the seconds they may wait;
+# requests beyond them are answered with 503
+QUEUE_MAX = 256
+QUEUE_DEADLINE = 1
+
+# a prefork worker exiting sooner than this after its start is restarted
+# only after the same delay, so a crashing worker cannot spin
+RESTART_DELAY = 1
+
 # get local hostname and ip address
 host_ip = '127.0.0.1'
 # host_name = socket.getfqdn()
@@ -13,30 +48,333 @@ host_ip = '127.0.0.1'
 host_port = 8181
 print(f'Host is {host_ip}, Port is {host_port}')
 
-# create a new socket object
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def listen(reuse_port=False):
+    '''
+    Create the listening socket.
+    Param
+    reuse_port: let every prefork worker listen on the port, the kernel
+    spreads new connections over them
+    Return
+    (socket): the listening socket
+    '''
+    # create a new socket object
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # allow restarting right away, e.g. between benchmark runs
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # bind the socket with host ip and port
+    sock.bind((host_ip, host_port))
+    # socket keep listening
+    sock.listen()
+    return sock
 
-# bind the socket with host ip and port
-s.bind((host_ip, host_port))
+if mode != 'prefork':
+    s = listen()
+    print('Server started. Waiting for connection...')
 
-# socket keep listening
-s.listen() 
-print('Server started. Waiting for connection...')
+# thread mode bound on the requests being handled
+admission = utils.Admission(HANDLER_WORKERS, QUEUE_MAX, QUEUE_DEADLINE)
 
 def handler(conn, addr):
-    (data, req) = utils.read_data(conn)
-    print('Server recv', len(data), 'data from', addr)
-    print('Server received: ', data)
-    resp = utils.generate_response(req)
-    utils.write_data(conn, resp)
-    print('Server send: ', resp)
+    # persistent connections are closed after sitting idle this long
+    conn.settimeout(utils.KEEP_ALIVE_TIMEOUT)
+    reader = utils.RequestReader(conn)
+
+    def admit(req):
+        # over the rate limit, refused before the body is read and streamed
+        # into its evaluation
+        return utils.check_rate(req, addr[0])
+
+    try:
+        # pipelined requests are read one after another and answered in order
+        while True:
+            (data, req) = utils.read_data(reader, admit)
+            if 'Refused' in req:
+                resp = utils.refuse(req, req['Refused'])
+            elif not admission.enter():
+                # a slot is taken only once the body is in, so slow senders
+                # cannot hold every slot, as event mode counts submitted work
+                resp = utils.refuse(req, '503 Service Unavailable')
+            else:
+                try:
+                    resp = utils.generate_response(req)
+                finally:
+                    admission.leave()
+            utils.write_data(conn, resp)
+            utils.request_log.request(addr, req, resp)
+            if not utils.keep_alive(req):
+                break
+    except utils.HttpError as e:
+        utils.write_data(conn, utils.prepare_error(e.status))
+    except (ConnectionError, socket.timeout):
+        pass
     conn.close() 
-    print('Server finished talking with', addr)
-    print('----------------------------------------------')
+
+class EventConnection:
+    '''
+    State of one connection in the event loop: buffered input, pending
+    output and whether a request of it is being handled by a worker.
+    Requests of one connection are handled one at a time, so pipelined
+    requests are answered in order.
+    '''
+
+    def __init__(self, conn, addr, admit):
+        self.conn = conn
+        self.addr = addr
+        self.requests = utils.RequestBuffer(lambda req: admit(self, req))
+        self.out = bytearray()
+        # FileResponse whose file is being sent after out
+        self.file = None
+        self.busy = False
+        self.closing = False
+        self.last_active = time.monotonic()
+
+def serve_event():
+    '''
+    Serve connections from one selectors loop. Handlers run on a pool of
+    HANDLER_WORKERS threads and post their responses back through a queue,
+    waking the loop with a socket pair. New connections are not accepted
+    while MAX_CONNECTIONS are open. Requests over the rate limit of their
+    client get a 429, requests finding QUEUE_MAX others waiting for the
+    pool or waiting longer than QUEUE_DEADLINE get a 503; both are checked
+    before the body is taken in.
+    '''
+    sel = selectors.DefaultSelector()
+    pool = ThreadPoolExecutor(HANDLER_WORKERS)
+    done = queue.SimpleQueue()
+    (wake_r, wake_w) = socket.socketpair()
+    wake_r.setblocking(False)
+    s.setblocking(False)
+    sel.register(s, selectors.EVENT_READ)
+    sel.register(wake_r, selectors.EVENT_READ)
+    clients = {}
+    accepting = True
+    last_sweep = time.monotonic()
+    # requests submitted to the pool and not answered yet
+    pending = 0
+
+    def run_handler(client, req, queued):
+        try:
+            if time.monotonic() - queued > QUEUE_DEADLINE:
+                resp = utils.refuse(req, '503 Service Unavailable')
+            else:
+                resp = utils.generate_response(req)
+        except Exception as e:
+            utils.request_log.error('Handler failed:', e)
+            resp = utils.error_response('500 Internal Server Error')
+            req['Headers']['connection'] = 'close'
+        utils.request_log.request(client.addr, req, resp)
+        done.put((client, req, resp))
+        wake_w.send(b'x')
+
+    def admit(client, req):
+        # refused before the body is taken in and streamed into its evaluation
+        status = utils.check_rate(req, client.addr[0])
+        if status is None and pending >= HANDLER_WORKERS + QUEUE_MAX:
+            status = '503 Service Unavailable'
+        return status
+
+    def close(client):
+        sel.unregister(client.conn)
+        client.conn.close()
+        if client.file is not None:
+            client.file.file.close()
+        del clients[client.conn]
+
+    def respond(client, req, resp):
+        # queue the response of the current request of a client; a client
+        # answered without socket events is still active
+        client.last_active = time.monotonic()
+        if isinstance(resp, utils.FileResponse):
+            client.out += resp.head
+            client.file = resp
+        else:
+            client.out += resp
+        if not utils.keep_alive(req):
+            client.closing = True
+
+    def flush(client):
+        # send what the socket takes; a file is sent after the bytes
+        # queued before it
+        try:
+            if client.out:
+                sent = client.conn.send(client.out)
+                del client.out[:sent]
+            if not client.out and client.file is not None:
+                resp = client.file
+                sent = os.sendfile(client.conn.fileno(), resp.file.fileno(), resp.offset, resp.count)
+                resp.offset += sent
+                resp.count -= sent
+                if resp.count == 0 or sent == 0:
+                    # a file cut short breaks the framing of the connection
+                    if resp.count:
+                        client.closing = True
+                    resp.file.close()
+                    client.file = None
+        except BlockingIOError:
+            pass
+
+    def update(client):
+        # flush what can be sent and start the next pipelined request; the
+        # next request waits for a file being sent, to keep the order
+        nonlocal pending
+        try:
+            flush(client)
+            # no request is started while its response could only pile up
+            while not client.busy and not client.closing and client.file is None \
+                    and len(client.out) < MAX_BUFFERED:
+                request = client.requests.next_request()
+                if request is None:
+                    break
+                (data, req) = request
+                # refused requests are answered here without queueing
+                if 'Refused' in req:
+                    resp = utils.refuse(req, req['Refused'])
+                else:
+                    client.busy = True
+                    pending += 1
+                    pool.submit(run_handler, client, req, time.monotonic())
+                    break
+                utils.request_log.request(client.addr, req, resp)
+                respond(client, req, resp)
+            flush(client)
+        except utils.HttpError as e:
+            client.out += utils.prepare_error(e.status)
+            client.closing = True
+        except ConnectionError:
+            close(client)
+            return
+        if client.closing and not client.out and not client.busy and client.file is None:
+            close(client)
+            return
+        events = selectors.EVENT_WRITE if client.out or client.file is not None else 0
+        if not client.closing and client.requests.buffered() < MAX_BUFFERED:
+            events |= selectors.EVENT_READ
+        sel.modify(client.conn, events, client)
+
+    while True:
+        for key, events in sel.select(timeout=1):
+            if key.fileobj is s:
+                try:
+                    conn, addr = s.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(False)
+                client = EventConnection(conn, addr, admit)
+                clients[conn] = client
+                sel.register(conn, selectors.EVENT_READ, client)
+            elif key.fileobj is wake_r:
+                try:
+                    wake_r.recv(4096)
+                except BlockingIOError:
+                    pass
+                while not done.empty():
+                    (client, req, resp) = done.get()
+                    pending -= 1
+                    if client.conn not in clients:
+                        continue
+                    client.busy = False
+                    respond(client, req, resp)
+                    update(client)
+            else:
+                client = key.data
+                client.last_active = time.monotonic()
+                if events & selectors.EVENT_READ:
+                    try:
+                        data = client.conn.recv(utils.READ_CHUNK_SIZE)
+                    except BlockingIOError:
+                        data = None
+                    except ConnectionError:
+                        close(client)
+                        continue
+                    if data == b'':
+                        close(client)
+                        continue
+                    if data:
+                        client.requests.feed(data)
+                update(client)
+        # close idle persistent connections, checked about once a second
+        curr_time = time.monotonic()
+        if curr_time - last_sweep >= 1:
+            last_sweep = curr_time
+            for client in list(clients.values()):
+                if not client.busy and not client.out and client.file is None \
+                        and curr_time - client.last_active > utils.KEEP_ALIVE_TIMEOUT:
+                    close(client)
+        # stop accepting at the cap and resume below it
+        if accepting and len(clients) >= MAX_CONNECTIONS:
+            sel.unregister(s)
+            accepting = False
+        elif not accepting and len(clients) < MAX_CONNECTIONS:
+            sel.register(s, selectors.EVENT_READ)
+            accepting = True
+
+def serve_threads():
+    '''
+    Serve every connection on its own thread.
+    '''
+    while True:
+        conn, addr = s.accept()
+        threading.Thread(target=handler, args=(conn, addr)).start()
+
+def serve_prefork(workers):
+    '''
+    Run the given number of worker processes, each listening on the port
+    with SO_REUSEPORT and serving in thread mode, and restart any worker
+    that exits. Request counts and recent expressions live in shared
+    memory, so /status reports all workers from any of them.
+    Param
+    workers: the number of worker processes
+    '''
+    stats = utils.SharedStats(workers, utils.api_count)
+    # pid -> (worker index, start time)
+    children = {}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            global s
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                stats.use(worker)
+                s = listen(reuse_port=True)
+                serve_threads()
+            finally:
+                os._exit(1)
+        children[pid] = (worker, time.monotonic())
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in range(workers):
+            spawn(worker)
+        print(f'Server started with {workers} workers. Waiting for connection...')
+        while True:
+            pid, status = os.wait()
+            # e.g. the resource tracker started for the shared memory
+            if pid not in children:
+                continue
+            (worker, started) = children.pop(pid)
+            print(f'Worker {worker} exited with status {status}, restarting')
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            spawn(worker)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+        stats.unlink()
 
 # main thread
-while True:
-    conn, addr = s.accept()
-    print('----------------------------------------------')
-    print('Server connected by', addr)
-    threading.Thread(target=handler, args=(conn, addr)).start()
+if mode == 'prefork':
+    serve_prefork(workers)
+if mode == 'event':
+    serve_event()
+serve_threads()
@@ -0,0 +1,118 @@
+# Stress test of the shared server state
+# Author: Yuanjie Yue
+# Date: 10/03/19
+
+# Usage: python stress.py [operations] [max threads]
+# Hammers the request counters, the recent expressions and the metrics
+# from many threads while others read them, checks that no update is lost,
+# then compares the throughput of the sharded counter with one global lock
+# as the number of threads grows. No server needs to be running.
+
+import sys
+import threading
+import time
+import utils
+
+def run_threads(count, target):
+    '''
+    Run target(i) on count threads started together, return the seconds taken.
+    '''
+    barrier = threading.Barrier(count + 1)
+
+    def run(i):
+        barrier.wait()
+        target(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def check(operations, threads):
+    '''
+    Update every structure from all threads with readers running alongside
+    and verify the totals afterwards.
+    '''
+    counter = utils.SlidingCounter()
+    recent = utils.RecentExpressions()
+    metrics = utils.Metrics()
+    stop = threading.Event()
+    failures = []
+
+    def write(i):
+        for j in range(operations):
+            metrics.start()
+            counter.add()
+            recent.add(f'{i}+{j % 20}')
+            metrics.finish('/api/stress', '200 OK', 0.0001)
+
+    def read():
+        last = 0
+        while not stop.is_set():
+            lifetime = counter.counts()[3]
+            if lifetime < last:
+                failures.append(f'lifetime went back from {last} to {lifetime}')
+            last = lifetime
+            snapshot = recent.snapshot()
+            if len(snapshot) > recent.size or len(set(snapshot)) != len(snapshot):
+                failures.append(f'bad recent expressions {snapshot}')
+            metrics.render()
+
+    readers = [threading.Thread(target=read) for i in range(2)]
+    for r in readers:
+        r.start()
+    run_threads(threads, write)
+    stop.set()
+    for r in readers:
+        r.join()
+
+    total = operations * threads
+    counts = counter.counts()
+    if counts != (total, total, total, total):
+        failures.append(f'counts {counts}, expected {total} each')
+    snapshot = recent.snapshot()
+    if len(snapshot) != recent.size or len(set(snapshot)) != recent.size:
+        failures.append(f'expected {recent.size} distinct recent expressions, got {snapshot}')
+    rendered = metrics.render()
+    for line in (f'http_requests_total{{route="/api/stress",code="200"}} {total}',
+                 f'http_request_duration_seconds_count{{route="/api/stress"}} {total}',
+                 'http_requests_in_flight 0'):
+        if line not in rendered.split('\n'):
+            failures.append(f'metrics miss {line}')
+    return failures
+
+def throughput(operations, threads, add):
+    '''
+    Return the counter updates per second with the given number of threads.
+    '''
+    def write(i):
+        for j in range(operations):
+            add()
+    return operations * threads / run_threads(threads, write)
+
+if __name__ == '__main__':
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    thread_counts = [1]
+    while thread_counts[-1] * 2 <= max_threads:
+        thread_counts.append(thread_counts[-1] * 2)
+
+    for threads in thread_counts:
+        failures = check(operations, threads)
+        print(f'{threads:>3} threads: {"ok" if not failures else "FAILED"}')
+        for failure in failures[:5]:
+            print('    ', failure)
+
+    print(f'{"threads":>7} {"sharded":>14} {"global lock":>14}   updates/s')
+    now = lambda: int(time.time())
+    for threads in thread_counts:
+        sharded = utils.SlidingCounter()
+        # merging every event on its own is the single global lock the
+        # shards replace
+        locked = utils.SlidingCounter()
+        print(f'{threads:>7} {throughput(operations, threads, sharded.add):>14.0f} '
+              f'{throughput(operations, threads, lambda: locked.merge(now(), 1)):>14.0f}')
@@ -2,16 +2,515 @@
 # Author: Yuanjie Yue
 # Date: 10/03/2019
 
+import gzip
+import hashlib
+import itertools
+import mimetypes
+import mmap
+import os
+import queue
+import re
 import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
 from datetime import datetime
-from collections import defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
+from multiprocessing import shared_memory
+from stat import S_ISREG
+from urllib.parse import unquote
 
-MAX_BUFF_SIZE = 16
+# byte budget of the evaluation cache, keys and values included
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# seconds a persistent connection may sit idle before it is closed
+KEEP_ALIVE_TIMEOUT = 5
+
+# seconds a rendered /status page may be served before updates show up;
+# 0 re-renders changed fragments on every request
+STATUS_MAX_STALENESS = 0.5
+# the /status page carries an ETag; clients may keep it but must check it
+# is still current, which costs them a 304 while nothing changed
+STATUS_CACHE_CONTROL = 'no-cache'
+
+# bytes asked from the socket per recv
+READ_CHUNK_SIZE = 64 * 1024
+# largest request line plus headers accepted
+MAX_HEADER_SIZE = 16 * 1024
+# chunked bodies and bodies at least this long are evaluated as they
+# arrive instead of being buffered whole
+STREAM_BODY_MIN = 64 * 1024
+# characters of a streamed expression shown on the /status page
+STREAM_PREVIEW_SIZE = 64
+
+# responses shorter than this are sent uncompressed, since the headers and
+# the compression itself would cost more than they save
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+# byte budget per encoding of the compressed reusable responses kept
+COMPRESS_CACHE_MAX_BYTES = 4 * 1024 * 1024
+# content codings in order of preference
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')
+
+# request logging; False turns it off entirely
+LOG_REQUESTS = True
+# one request in this many is logged
+LOG_SAMPLE = 10
+# lines written to stdout at once by the log thread
+LOG_BATCH = 256
+
+# directory served to GET requests outside the apis; None answers them with
+# 404. Point it at a directory holding only files meant for clients, never
+# at the sources, e.g. os.path.join(os.path.dirname(__file__), 'www')
+DOC_ROOT = None
+# files up to this size are served from an mmap cache, larger ones are
+# sent straight from the file with sendfile
+STATIC_MMAP_MAX_SIZE = 256 * 1024
+# byte budget of the mmap cache
+STATIC_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# per-client rate limit: a client address gets RATE_BURST tokens to start
+# with and RATE_LIMIT more per second, a request costs one token and is
+# answered with 429 when the tokens run out; 0 turns the limit off, e.g. to
+# load test from one machine
+RATE_LIMIT = 1000
+RATE_BURST = 2000
+# bodies cost one more token per RATE_COST_BYTES when set, and one whose
+# cost can never fit in RATE_BURST is answered with 413; raise RATE_BURST
+# with it to the largest upload a client may stream at once. 0 charges
+# every request alike, so streamed bodies of any length are taken
+RATE_COST_BYTES = 0
+# client addresses tracked by the rate limiter, the ones seen first are
+# forgotten beyond it
+RATE_LIMIT_CLIENTS = 64 * 1024
+
+# content types of responses, the first is the default
+CONTENT_TYPES = ('text/html', 'text/plain; version=0.0.4; charset=utf-8')
+
+# shards of the counters updated by every request; threads are spread over
+# them so concurrent handlers rarely wait for each other
+COUNTER_SHARDS = 16
+# expressions shown on the /status page
+LAST_EXPRESSIONS = 10
+# bytes of an expression kept in shared memory by prefork workers
+SHARED_EXPRESSION_SIZE = 256
+
+def shard_index():
+    '''
+    Return
+    (int): the counter shard of the calling thread
+    '''
+    # native thread ids are small consecutive numbers, unlike get_ident
+    return threading.get_native_id() % COUNTER_SHARDS
+
+class CounterShard:
+    '''
+    Events of the current second counted by the threads of one shard.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.second = 0
+        self.count = 0
+
+class SlidingCounter:
+    '''
+    Count events over the last minute, hour and 24 hours plus the lifetime
+    in fixed memory. Events go into one bucket per second of a ring that
+    spans a day, and a running sum per window drops the bucket that falls
+    out of it as each second passes, so adding and reading are O(1).
+    Handler threads count into COUNTER_SHARDS shards of the current second,
+    which are merged into the ring when their second is over or when the
+    counts are read, so the ring lock is taken about once a second per
+    shard instead of once per event.
+    '''
+
+    # window lengths in seconds
+    WINDOWS = (60, 60 * 60, 24 * 60 * 60)
+    SLOTS = 24 * 60 * 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = array('L', [0]) * self.SLOTS
+        self.sums = [0] * len(self.WINDOWS)
+        self.lifetime = 0
+        self.second = int(time.time())
+        self.shards = [CounterShard() for i in range(COUNTER_SHARDS)]
+
+    def advance(self, second):
+        '''
+        Move the ring forward to the given second.
+        Param
+        second: current time in whole seconds
+        '''
+        if second <= self.second:
+            return
+        if second - self.second >= self.SLOTS:
+            # idle for a whole day: every window is empty
+            self.buckets = array('L', [0]) * self.SLOTS
+            self.sums = [0] * len(self.WINDOWS)
+        else:
+            buckets, sums = self.buckets, self.sums
+            for curr in range(self.second + 1, second + 1):
+                # the second that leaves each window as curr enters it
+                for i, window in enumerate(self.WINDOWS):
+                    sums[i] -= buckets[(curr - window) % self.SLOTS]
+                buckets[curr % self.SLOTS] = 0
+        self.second = second
+
+    def merge(self, second, count):
+        '''
+        Add the events counted by a shard in the given second to the ring.
+        The caller holds the lock of the shard, never the other way round.
+        Param
+        second: the second the events happened in
+        count: the number of events
+        '''
+        with self.lock:
+            self.advance(max(second, int(time.time())))
+            if second > self.second - self.SLOTS:
+                self.buckets[second % self.SLOTS] += count
+                for i, window in enumerate(self.WINDOWS):
+                    if second > self.second - window:
+                        self.sums[i] += count
+            self.lifetime += count
+
+    def add(self):
+        '''
+        Count one event now.
+        '''
+        second = int(time.time())
+        shard = self.shards[shard_index()]
+        with shard.lock:
+            if shard.second != second:
+                if shard.count:
+                    self.merge(shard.second, shard.count)
+                shard.second = second
+                shard.count = 0
+            shard.count += 1
+
+    def counts(self):
+        '''
+        Return
+        (tuple): events in the last minute, hour and 24 hours, and lifetime
+        '''
+        second = int(time.time())
+        pending = 0
+        for shard in self.shards:
+            with shard.lock:
+                if shard.second >= second:
+                    pending += shard.count
+                elif shard.count:
+                    self.merge(shard.second, shard.count)
+                    shard.count = 0
+        with self.lock:
+            self.advance(second)
+            # events of the current second are in every window
+            return tuple(total + pending for total in self.sums) + (self.lifetime + pending,)
+
+class RecentExpressions:
+    '''
+    The most recent distinct expressions, at most size of them. Adding an
+    expression already kept moves it to the front; both that and dropping
+    the oldest are O(1).
+    Param
+    size: the number of expressions kept
+    '''
+
+    def __init__(self, size=LAST_EXPRESSIONS):
+        self.size = size
+        self.lock = threading.Lock()
+        # expression -> None, oldest first
+        self.entries = OrderedDict()
+
+    def add(self, expression):
+        '''
+        Record an expression as the most recent.
+        '''
+        with self.lock:
+            self.entries[expression] = None
+            self.entries.move_to_end(expression)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def snapshot(self):
+        '''
+        Return
+        (list): the expressions, most recent first
+        '''
+        with self.lock:
+            return list(reversed(self.entries))
+
+class SharedStats:
+    '''
+    Request counts and recent expressions of all prefork workers in one
+    multiprocessing.shared_memory segment, created before the workers are
+    forked. Each worker writes only its own region, so workers never wait
+    for each other, and readers merge the regions of all workers.
+    Region of a worker, 8-byte aligned:
+        per api: second (q), lifetime (q), sequence (q), one sum per
+            window (q) * 3, one count per second (I) * SLOTS
+        per recent expression: time in ns (q), length (q), bytes
+    Param
+    workers: the number of worker processes
+    apis: the counted apis
+    '''
+
+    # second, lifetime, sequence and one sum per window, see SharedCounter
+    COUNTER_HEADER_SIZE = 8 * (3 + len(SlidingCounter.WINDOWS))
+    COUNTER_SIZE = COUNTER_HEADER_SIZE + 4 * SlidingCounter.SLOTS
+    EXPRESSION_SIZE = 16 + SHARED_EXPRESSION_SIZE
+
+    def __init__(self, workers, apis):
+        self.workers = workers
+        self.apis = list(apis)
+        self.region_size = len(self.apis) * self.COUNTER_SIZE + LAST_EXPRESSIONS * self.EXPRESSION_SIZE
+        self.shm = shared_memory.SharedMemory(create=True, size=workers * self.region_size)
+        # the segment starts zeroed, which is an empty state for every region
+        self.counters = {api: [self.counter_view(worker, i) for worker in range(workers)]
+                         for i, api in enumerate(self.apis)}
+        self.expressions = [[self.expression_view(worker, i) for i in range(LAST_EXPRESSIONS)]
+                            for worker in range(workers)]
+
+    def counter_view(self, worker, api_index):
+        '''
+        Return
+        (tuple): the header and the buckets of one counter
+        '''
+        offset = worker * self.region_size + api_index * self.COUNTER_SIZE
+        buf = self.shm.buf
+        header_end = offset + self.COUNTER_HEADER_SIZE
+        return (buf[offset:header_end].cast('q'), buf[header_end:offset + self.COUNTER_SIZE].cast('I'))
+
+    def expression_view(self, worker, slot):
+        '''
+        Return
+        (tuple): the header (time, length) and the bytes of one expression slot
+        '''
+        offset = (worker * self.region_size + len(self.apis) * self.COUNTER_SIZE
+                  + slot * self.EXPRESSION_SIZE)
+        buf = self.shm.buf
+        return (buf[offset:offset + 16].cast('q'), buf[offset + 16:offset + self.EXPRESSION_SIZE])
+
+    def use(self, worker):
+        '''
+        Make the calling worker process count into its region of the
+        segment, replacing the process-local api_count and last ten.
+        Param
+        worker: the index of the worker
+        '''
+        global last_ten_expressions
+        counters = [SharedCounter(self.counters[api], worker) for api in self.apis]
+        for api, counter in zip(self.apis, counters):
+            api_count[api] = counter
+        last_ten_expressions = SharedRecentExpressions(self.expressions, worker)
+
+        def tick():
+            while True:
+                for counter in counters:
+                    counter.tick()
+                time.sleep(1)
+
+        threading.Thread(target=tick, daemon=True).start()
+
+    def unlink(self):
+        '''
+        Remove the segment, once every worker has exited.
+        '''
+        self.counters = self.expressions = None
+        self.shm.close()
+        self.shm.unlink()
+
+class SharedCounter:
+    '''
+    SlidingCounter of one prefork worker in shared memory. The worker adds
+    to its own ring and, as SlidingCounter does, keeps a running sum per
+    window in the header of its region, dropping the bucket that falls out
+    of each window as a second passes. The worker ticks its counters once a
+    second, so a ring is never more than a few seconds behind, and counts
+    adds up the sums of every worker corrected for those seconds, in
+    O(workers). The header carries a sequence number that is odd while the
+    worker updates it, and a header that changed while it was read is read
+    again, so it is never read torn.
+    Param
+    views: (header, buckets) of the counter of every worker
+    worker: the index of the calling worker
+    '''
+
+    # fields of the header
+    (SECOND, LIFETIME, SEQUENCE, SUMS) = range(4)
+    HEADER_FIELDS = SUMS + len(SlidingCounter.WINDOWS)
+
+    # times a reader reads a header again before taking it as it is, e.g.
+    # when a worker was killed while updating it
+    READ_ATTEMPTS = 1000
+
+    def __init__(self, views, worker):
+        self.views = views
+        (self.header, self.buckets) = views[worker]
+        self.lock = threading.Lock()
+        # a worker restarted in place of one killed while updating
+        if self.header[self.SEQUENCE] % 2:
+            self.header[self.SEQUENCE] += 1
+
+    def advance(self, second):
+        '''
+        Move the ring of the worker forward to the given second. The caller
+        holds the lock and has made the sequence number odd.
+        Param
+        second: current time in whole seconds
+        '''
+        header, buckets = self.header, self.buckets
+        last = header[self.SECOND]
+        if second <= last:
+            return
+        if second - last >= SlidingCounter.SLOTS:
+            # idle for a whole day: every window is empty
+            buckets[:] = array('I', bytes(len(buckets) * 4))
+            for i in range(len(SlidingCounter.WINDOWS)):
+                header[self.SUMS + i] = 0
+        else:
+            for curr in range(last + 1, second + 1):
+                # the second that leaves each window as curr enters it
+                for i, window in enumerate(SlidingCounter.WINDOWS):
+                    header[self.SUMS + i] -= buckets[(curr - window) % SlidingCounter.SLOTS]
+                buckets[curr % SlidingCounter.SLOTS] = 0
+        header[self.SECOND] = second
+
+    def add(self):
+        '''
+        Count one event now.
+        '''
+        second = int(time.time())
+        with self.lock:
+            header = self.header
+            header[self.SEQUENCE] += 1
+            self.advance(second)
+            self.buckets[header[self.SECOND] % SlidingCounter.SLOTS] += 1
+            for i in range(len(SlidingCounter.WINDOWS)):
+                header[self.SUMS + i] += 1
+            header[self.LIFETIME] += 1
+            header[self.SEQUENCE] += 1
+
+    def tick(self):
+        '''
+        Move the ring forward to the current second, so readers need not
+        correct the sums for more than the seconds since the last tick.
+        '''
+        with self.lock:
+            self.header[self.SEQUENCE] += 1
+            self.advance(int(time.time()))
+            self.header[self.SEQUENCE] += 1
+
+    def counts(self):
+        '''
+        Return
+        (tuple): events of all workers in the last minute, hour and 24
+        hours, and lifetime
+        '''
+        now = int(time.time())
+        totals = [0] * len(SlidingCounter.WINDOWS)
+        lifetime = 0
+        for header, buckets in self.views:
+            for attempt in range(self.READ_ATTEMPTS):
+                sequence = header[self.SEQUENCE]
+                last = header[self.SECOND]
+                sums = list(header[self.SUMS:self.HEADER_FIELDS])
+                for i, window in enumerate(SlidingCounter.WINDOWS):
+                    # drop the seconds that left the window since the last
+                    # second of the worker
+                    if now - last >= window:
+                        sums[i] = 0
+                    elif now > last:
+                        sums[i] -= ring_sum(buckets, last - window + 1, now - window)
+                worker_lifetime = header[self.LIFETIME]
+                if sequence % 2 == 0 and header[self.SEQUENCE] == sequence:
+                    break
+            for i, total in enumerate(sums):
+                totals[i] += total
+            lifetime += worker_lifetime
+        return tuple(totals) + (lifetime,)
+
+def ring_sum(buckets, start, end):
+    '''
+    Sum the buckets of the seconds from start to end, both included, in a
+    ring of one bucket per second.
+    '''
+    slots = len(buckets)
+    first, last = start % slots, end % slots
+    if end - start + 1 >= slots:
+        return sum(buckets)
+    if first <= last:
+        return sum(buckets[first:last + 1])
+    return sum(buckets[first:]) + sum(buckets[:last + 1])
+
+class SharedRecentExpressions:
+    '''
+    RecentExpressions of one prefork worker in shared memory. The worker
+    keeps its own LAST_EXPRESSIONS slots stamped with the time they were
+    added; snapshot merges the slots of every worker. A slot is stamped
+    after it is written and read again after it is copied, so a slot being
+    rewritten is skipped instead of read torn.
+    Param
+    slots: the (header, data) slots of every worker
+    worker: the index of the calling worker
+    '''
+
+    def __init__(self, slots, worker):
+        self.slots = slots
+        self.own = slots[worker]
+        self.lock = threading.Lock()
+
+    def add(self, expression):
+        '''
+        Record an expression as the most recent.
+        '''
+        data = expression.encode('utf8')
+        kept = data[:SHARED_EXPRESSION_SIZE]
+        with self.lock:
+            # reuse the slot of the same expression, else the oldest one
+            (header, buf) = min(self.own, key=lambda slot: slot[0][0])
+            for slot in self.own:
+                if slot[0][0] and slot[0][1] == len(data) and bytes(slot[1][:len(kept)]) == kept:
+                    (header, buf) = slot
+                    break
+            header[0] = 0
+            buf[:len(kept)] = kept
+            header[1] = len(data)
+            header[0] = time.time_ns()
+
+    def snapshot(self):
+        '''
+        Return
+        (list): the expressions of all workers, most recent first
+        '''
+        latest = {}
+        for worker_slots in self.slots:
+            for header, buf in worker_slots:
+                stamp, length = header[0], header[1]
+                data = bytes(buf[:min(length, SHARED_EXPRESSION_SIZE)])
+                if not stamp or header[0] != stamp:
+                    continue
+                key = (data, length)
+                if latest.get(key, 0) < stamp:
+                    latest[key] = stamp
+        expressions = []
+        for (data, length), stamp in sorted(latest.items(), key=lambda item: -item[1])[:LAST_EXPRESSIONS]:
+            expression = data.decode('utf8', 'ignore')
+            if length > len(data):
+                expression += '...'
+            expressions.append(expression)
+        return expressions
 
 api_count = {}
-api_count['/api/evalexpression'] = []
-api_count['/api/gettime'] = []
-last_ten_expressions = []
+api_count['/api/evalexpression'] = SlidingCounter()
+api_count['/api/gettime'] = SlidingCounter()
+last_ten_expressions = RecentExpressions()
 
 def now():
     '''
@@ -19,116 +518,927 @@ def now():
     '''
     return datetime.now()
 
-def read_n_bytes(conn, n):
-    data = bytearray()
-    while len(data) < n:
-        remain_len = n - len(data)
-        buff_size = min(MAX_BUFF_SIZE, remain_len)
-        data += conn.recv(buff_size)
-    return bytes(data)
+class HttpError(Exception):
+    '''
+    A request that cannot be served; the connection is answered with the
+    given status and closed.
+    Param
+    status: status code and reason, e.g. '400 Bad Request'
+    '''
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
 
-def read_data(conn):
+class RequestReader:
     '''
-    Read bytes from socket and return it as string.
+    Buffered reader of HTTP requests on one connection. It receives large
+    chunks, searches only the new bytes for the end of the headers and
+    keeps whatever follows for the body and the next pipelined request.
     Param
     conn: socket connection
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buf = bytearray()
+
+    def recv(self):
+        '''
+        Append the next chunk from the socket to the buffer.
+        '''
+        chunk = self.conn.recv(READ_CHUNK_SIZE)
+        if not chunk:
+            raise ConnectionError('connection closed by peer')
+        self.buf += chunk
+
+    def read_head(self):
+        '''
+        Read the request line and headers.
+        Return
+        (bytes): everything before the blank line ending the headers
+        '''
+        scanned = 0
+        while True:
+            # the terminator may straddle the previous chunk and this one
+            end = self.buf.find(b'\r\n\r\n', max(0, scanned - 3))
+            if end >= 0:
+                break
+            if len(self.buf) > MAX_HEADER_SIZE:
+                raise HttpError('431 Request Header Fields Too Large')
+            scanned = len(self.buf)
+            self.recv()
+        if end > MAX_HEADER_SIZE:
+            raise HttpError('431 Request Header Fields Too Large')
+        head = bytes(self.buf[:end])
+        del self.buf[:end + 4]
+        return head
+
+    def read_body(self, n):
+        '''
+        Read exactly n bytes of body, starting with the bytes already buffered.
+        Param
+        n: number of bytes to read
+        Return
+        (bytes): the body
+        '''
+        if len(self.buf) >= n:
+            body = bytes(self.buf[:n])
+            del self.buf[:n]
+            return body
+        # receive the rest straight into its final place, never past the body
+        body = bytearray(n)
+        buffered = len(self.buf)
+        body[:buffered] = self.buf
+        self.buf.clear()
+        view = memoryview(body)
+        while buffered < n:
+            curr_len = self.conn.recv_into(view[buffered:])
+            if curr_len == 0:
+                raise ConnectionError('connection closed by peer')
+            buffered += curr_len
+        return bytes(body)
+
+    def read_stream(self, decoder):
+        '''
+        Pass the body to the decoder as it is received.
+        Param
+        decoder: a BodyDecoder, consuming the buffer in place
+        '''
+        while not decoder.feed(self.buf):
+            self.recv()
+
+def parse_head(head):
+    '''
+    Parse the request line and headers.
+    Param
+    head: the request line and headers as bytes
     Return
-    tuple: the read data and request parsed
+    (dict): the request, with header names lowercased under 'Headers'
     '''
-    data = b''
     req = {}
-    while b'\r\n\r\n' not in data:
-        data += read_n_bytes(conn, 1)
-    # get rid of the rear '\r\n\r\n'
-    http_req_header = data[:-4].decode('utf8').split('\r\n')
+    http_req_header = head.decode('utf8', 'replace').split('\r\n')
     # get the first line
     http_req_line = http_req_header[0]
     http_req_line_parts = http_req_line.split(' ')
     http_req_line_parts_len = len(http_req_line_parts)
     if http_req_line_parts_len > 0 and len(http_req_line_parts[0]) > 0:
         req['Http-Method'] = http_req_line_parts[0]
-        print('http method', req['Http-Method'])
-    else:
-        print('http method not provided!')
     if http_req_line_parts_len > 1 and len(http_req_line_parts[1]) > 0:
         req['Api'] = http_req_line_parts[1]
-        print('api', req['Api'])
-    else:
-        print('api not provided!')
     if http_req_line_parts_len > 2 and len(http_req_line_parts[2]) > 0:
         req['Http-Version'] = http_req_line_parts[2]
-        print('http version', req['Http-Version'])
+
+    headers = {}
+    for line in http_req_header[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HttpError('400 Bad Request')
+        headers[name.strip().lower()] = value.strip()
+    req['Headers'] = headers
+    return req
+
+def get_content_length(req):
+    '''
+    Get the declared body length of the request.
+    Param
+    req: the parsed request
+    Return
+    (int): the Content-Length, 0 if there is none
+    '''
+    headers = req['Headers']
+    if 'content-length' not in headers:
+        return 0
+    try:
+        content_length = int(headers['content-length'])
+    except ValueError:
+        raise HttpError('400 Bad Request')
+    if content_length < 0:
+        raise HttpError('400 Bad Request')
+    return content_length
+
+def is_chunked(req):
+    '''
+    Check whether the request body uses chunked transfer encoding; any
+    other transfer coding is rejected.
+    Param
+    req: the parsed request
+    Return
+    (bool): True if the body is chunked
+    '''
+    headers = req['Headers']
+    if 'transfer-encoding' not in headers:
+        return False
+    if headers['transfer-encoding'].lower() != 'chunked':
+        raise HttpError('501 Not Implemented')
+    # a body framed twice could be read differently by a proxy in front
+    if 'content-length' in headers:
+        raise HttpError('400 Bad Request')
+    return True
+
+def parse_chunk_size(line):
+    '''
+    Parse the size line of a chunk, ignoring chunk extensions.
+    Param
+    line: the line before the chunk data, as bytes
+    Return
+    (int): the chunk size
+    '''
+    size = line.split(b';', 1)[0].strip()
+    try:
+        if not size or size[0] in b'+-':
+            raise ValueError(size)
+        return int(size, 16)
+    except ValueError:
+        raise HttpError('400 Bad Request')
+
+class BodyDecoder:
+    '''
+    Incremental decoder of a request body framed by Content-Length or by
+    chunked transfer encoding. Every feed consumes what it can from the
+    front of the connection buffer and hands the body bytes to on_data, so
+    no more than one received chunk of the body is held at a time.
+    Param
+    on_data: called with each piece of the decoded body
+    length: the Content-Length, None for a chunked body
+    '''
+
+    def __init__(self, on_data, length=None):
+        self.on_data = on_data
+        self.chunked = length is None
+        self.remaining = 0 if self.chunked else length
+        # 'size', 'data', 'crlf' after a chunk, or 'trailer'
+        self.state = 'size' if self.chunked else 'data'
+
+    def feed(self, buf):
+        '''
+        Decode from the front of buf, deleting the bytes used.
+        Param
+        buf: bytearray of received bytes
+        Return
+        (bool): True once the whole body was decoded
+        '''
+        while True:
+            if self.state == 'data':
+                n = min(self.remaining, len(buf))
+                if n:
+                    self.on_data(bytes(buf[:n]))
+                    del buf[:n]
+                    self.remaining -= n
+                if self.remaining:
+                    return False
+                if not self.chunked:
+                    return True
+                self.state = 'crlf'
+            elif self.state == 'crlf':
+                if len(buf) < 2:
+                    return False
+                if buf[:2] != b'\r\n':
+                    raise HttpError('400 Bad Request')
+                del buf[:2]
+                self.state = 'size'
+            else:
+                end = buf.find(b'\r\n')
+                if end < 0:
+                    if len(buf) > MAX_HEADER_SIZE:
+                        raise HttpError('400 Bad Request')
+                    return False
+                line = bytes(buf[:end])
+                del buf[:end + 2]
+                if self.state == 'trailer':
+                    # trailer fields are not used, the blank line ends the body
+                    if not line:
+                        return True
+                    continue
+                self.remaining = parse_chunk_size(line)
+                self.state = 'data' if self.remaining else 'trailer'
+
+def stream_decoder(req):
+    '''
+    Set up streaming evaluation of the request body if it is chunked or
+    too long to buffer.
+    Param
+    req: the parsed request
+    Return
+    BodyDecoder feeding req['Evaluator'], or None to buffer the body
+    '''
+    if is_chunked(req):
+        length = None
     else:
-        print('http version not provided!')
+        length = get_content_length(req)
+        if length < STREAM_BODY_MIN:
+            return None
+    req['Evaluator'] = StreamEvaluator()
+    on_data = req['Evaluator'].feed
+    if length is None and 'Client' in req:
+        on_data = ChargedStream(req, on_data).feed
+    return BodyDecoder(on_data, length)
 
-    http_header_lines = http_req_header[1:]
-    http_header_lines_parts = dict([i.lower().split(': ') for i in http_header_lines])
+def refused_early(req, status):
+    '''
+    Decide how a request refused by admit before its body is read goes on:
+    a short body is still read, so the connection is kept and the request
+    is answered in order, a streamed one is not read at all.
+    Param
+    req: the parsed request
+    status: status code and reason of the refusal
+    Raise
+    HttpError: for a streamed body, the connection is answered and closed
+    '''
+    req['Refused'] = status
+    if is_chunked(req) or get_content_length(req) >= STREAM_BODY_MIN:
+        count_refusal(req, status)
+        raise HttpError(status)
+
+def set_content(req, content):
+    '''
+    Attach the body to the request.
+    '''
+    req['Content'] = content.decode('utf8', 'replace')
 
-    if 'content-length' in http_header_lines_parts:
-        content_length = int(http_header_lines_parts['content-length'])
-        print('Content-length is', content_length)
-        content = read_n_bytes(conn, content_length)
+def read_data(reader, admit=None):
+    '''
+    Read one request from the connection.
+    Param
+    reader: the RequestReader of the connection
+    admit: called with the parsed request before its body is read, returns
+    the status to refuse it with or None; a refused request is returned
+    with req['Refused'] set
+    Return
+    tuple: the read data and request parsed
+    '''
+    head = reader.read_head()
+    req = parse_head(head)
+    data = head + b'\r\n\r\n'
+    if admit is not None:
+        status = admit(req)
+        if status is not None:
+            refused_early(req, status)
+    decoder = stream_decoder(req)
+    if decoder is not None:
+        reader.read_stream(decoder)
+        return (data, req)
+    content_length = get_content_length(req)
+    if 'content-length' in req['Headers']:
+        content = reader.read_body(content_length)
         data += content
-        req['Content'] = content.decode('utf8')
-        print('Content is', req['Content'])
+        set_content(req, content)
     return (data, req)
 
+class RequestBuffer:
+    '''
+    Non-blocking counterpart of RequestReader for event-driven servers:
+    received bytes are pushed in with feed and complete requests are taken
+    out with next_request, in order. The parsed head of a request whose
+    body is still arriving is kept, so it is parsed only once, and a
+    streamed body is decoded as it arrives.
+    Param
+    admit: called with each parsed request before its body is taken in,
+    as in read_data
+    '''
+
+    def __init__(self, admit=None):
+        self.admit = admit
+        self.buf = bytearray()
+        self.scanned = 0
+        # (head, request, content length, stream decoder) while waiting
+        # for the body
+        self.pending = None
+
+    def feed(self, data):
+        self.buf += data
+
+    def buffered(self):
+        '''
+        Return the number of bytes received but not taken out yet.
+        '''
+        return len(self.buf)
+
+    def next_request(self):
+        '''
+        Take the next complete request out of the buffer.
+        Return
+        tuple: the read data and request parsed, or None if the request is
+        not complete yet
+        '''
+        if self.pending is None:
+            end = self.buf.find(b'\r\n\r\n', max(0, self.scanned - 3))
+            if end < 0:
+                self.scanned = len(self.buf)
+                if self.scanned > MAX_HEADER_SIZE:
+                    raise HttpError('431 Request Header Fields Too Large')
+                return None
+            if end > MAX_HEADER_SIZE:
+                raise HttpError('431 Request Header Fields Too Large')
+            head = bytes(self.buf[:end])
+            del self.buf[:end + 4]
+            self.scanned = 0
+            req = parse_head(head)
+            if self.admit is not None:
+                status = self.admit(req)
+                if status is not None:
+                    refused_early(req, status)
+            decoder = stream_decoder(req)
+            content_length = 0 if decoder is not None else get_content_length(req)
+            self.pending = (head, req, content_length, decoder)
+        (head, req, content_length, decoder) = self.pending
+        if decoder is not None:
+            if not decoder.feed(self.buf):
+                return None
+        elif len(self.buf) < content_length:
+            return None
+        self.pending = None
+        data = head + b'\r\n\r\n'
+        if decoder is None and 'content-length' in req['Headers']:
+            content = bytes(self.buf[:content_length])
+            del self.buf[:content_length]
+            data += content
+            set_content(req, content)
+        return (data, req)
+
+def keep_alive(req):
+    '''
+    Decide whether the connection stays open after this request: HTTP/1.1
+    keeps it unless the client sent 'Connection: close', HTTP/1.0 closes it
+    unless the client sent 'Connection: keep-alive'.
+    Param
+    req: the parsed request
+    Return
+    (bool): True to keep the connection open
+    '''
+    connection = req.get('Headers', {}).get('connection', '').lower()
+    if req.get('Http-Version') == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+def prepare_error(status):
+    '''
+    Prepare the response to a request that could not be read; the
+    connection is closed after it.
+    Param
+    status: status code and reason
+    Return
+    (bytes): the http response
+    '''
+    return error_response(status)
+
 def write_data(conn, resp):
     '''
     Write the bytes data to the socket connection.
     Param
     conn: socket connection
-    resp: response message to be sent 
+    resp: response message to be sent, bytes or a FileResponse
     '''
+    if isinstance(resp, FileResponse):
+        conn.sendall(resp.head)
+        try:
+            # sendfile copies from the page cache to the socket in the kernel
+            conn.sendfile(resp.file, resp.offset, resp.count)
+        finally:
+            resp.file.close()
+        return
     conn.sendall(resp)
 
+class RateLimiter:
+    '''
+    Per-client token buckets. The buckets are spread over COUNTER_SHARDS
+    locks by client address, so concurrent handlers rarely wait for each
+    other, and a shard forgets the clients it saw first once it holds its
+    part of max_clients.
+    Param
+    rate: tokens added per second, 0 lets every request through
+    burst: tokens a bucket holds at most
+    max_clients: clients tracked at most
+    '''
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, max_clients=RATE_LIMIT_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.shard_size = max(1, max_clients // COUNTER_SHARDS)
+        # client -> (tokens, monotonic time of the last update) per shard
+        self.shards = [(threading.Lock(), {}) for i in range(COUNTER_SHARDS)]
+
+    def allow(self, client, cost=1):
+        '''
+        Take tokens from the bucket of a client.
+        Param
+        client: the client address
+        cost: the tokens the request costs
+        Return
+        (bool): whether the request may be handled
+        '''
+        if self.rate <= 0:
+            return True
+        (lock, buckets) = self.shards[hash(client) % COUNTER_SHARDS]
+        curr_time = time.monotonic()
+        with lock:
+            bucket = buckets.get(client)
+            if bucket is None:
+                if len(buckets) >= self.shard_size:
+                    del buckets[next(iter(buckets))]
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (curr_time - bucket[1]) * self.rate)
+            allowed = tokens >= cost
+            buckets[client] = (tokens - cost if allowed else tokens, curr_time)
+            return allowed
+
+def request_cost(req):
+    '''
+    Get the tokens a request costs, more for longer bodies if RATE_COST_BYTES
+    is set. A chunked body is charged while it is decoded, see ChargedStream.
+    Param
+    req: the parsed request
+    Return
+    (int): the cost
+    '''
+    if RATE_COST_BYTES <= 0:
+        return 1
+    return 1 + get_content_length(req) // RATE_COST_BYTES
+
+def check_rate(req, client):
+    '''
+    Charge a request to the rate limit of its client once its head is
+    parsed, before the body is read.
+    Param
+    req: the parsed request
+    client: the client address
+    Return
+    (str): the status to refuse the request with, or None
+    '''
+    cost = request_cost(req)
+    if rate_limiter.rate > 0 and cost > rate_limiter.burst:
+        # no bucket ever holds enough tokens for this body
+        return '413 Content Too Large'
+    if not rate_limiter.allow(client, cost):
+        return '429 Too Many Requests'
+    if RATE_COST_BYTES > 0:
+        req['Client'] = client
+    return None
+
+class ChargedStream:
+    '''
+    Charge a chunked body to the rate limit of its client as it arrives, one
+    token per RATE_COST_BYTES, and stop it with 429 once the tokens run out.
+    Param
+    req: the parsed request, checked by check_rate
+    on_data: called with each piece of the body that was paid for
+    '''
+
+    def __init__(self, req, on_data):
+        self.req = req
+        self.on_data = on_data
+        self.received = 0
+
+    def feed(self, piece):
+        paid = self.received // RATE_COST_BYTES
+        self.received += len(piece)
+        cost = self.received // RATE_COST_BYTES - paid
+        if cost and not rate_limiter.allow(self.req['Client'], cost):
+            count_refusal(self.req, '429 Too Many Requests')
+            raise HttpError('429 Too Many Requests')
+        self.on_data(piece)
+
+class Admission:
+    '''
+    Bounded admission of requests to their handlers: at most slots run at
+    once and at most queue_size wait for a slot. A request finding the
+    queue full, or waiting longer than deadline seconds, is refused, since
+    it would be answered later than its client is likely to wait.
+    Param
+    slots: handlers running at once
+    queue_size: requests waiting at most
+    deadline: seconds a request may wait
+    '''
+
+    def __init__(self, slots, queue_size, deadline):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.running = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def enter(self):
+        '''
+        Wait for a slot.
+        Return
+        (bool): True if the request got a slot and must call leave
+        '''
+        with self.cond:
+            if self.running < self.slots:
+                self.running += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                admitted = self.cond.wait_for(lambda: self.running < self.slots, self.deadline)
+            finally:
+                self.waiting -= 1
+            if admitted:
+                self.running += 1
+            return admitted
+
+    def leave(self):
+        '''
+        Give the slot back.
+        '''
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+# path -> {method -> (handler, content type, cache control)}, filled by the
+# route decorator
+routes = defaultdict(dict)
+
+SUPPORTED_VERSIONS = ('HTTP/1.0', 'HTTP/1.1')
+
+def route(method, *paths, content_type=CONTENT_TYPES[0], cache_control=None):
+    '''
+    Register the decorated function as the handler of the method on the
+    given paths. A handler takes the parsed request and returns the status
+    and the content of the response. A handler may put the ETag of its
+    content under 'ETag' in the request and return '304 Not Modified'
+    when the client already has it.
+    Param
+    method: http method, e.g. 'GET'
+    paths: the paths served by the handler
+    content_type: the content type of its responses, one of CONTENT_TYPES
+    cache_control: the Cache-Control of its responses, or None
+    '''
+    def register(handler):
+        for path in paths:
+            routes[path][method] = (handler, content_type, cache_control)
+        return handler
+    return register
+
 def generate_response(req):
     '''
-    Generate response bytes based on the given request.
+    Generate response bytes based on the given request, recording the
+    status under 'Status' and the seconds taken under 'Latency' in the
+    request, and both in the metrics of its route.
     Param
     req: requset string
     Return
     (bytes): the relative response
     '''
-    resp = {}
-    resp['Status-Code'] = '200 OK'
+    start = time.perf_counter()
+    metrics.start()
+    status = '500 Internal Server Error'
+    try:
+        (status, resp) = dispatch(req)
+        return resp
+    finally:
+        req['Status'] = status
+        req['Latency'] = time.perf_counter() - start
+        metrics.finish(route_label(req), status, req['Latency'])
+
+def route_label(req):
+    '''
+    Get the metrics label of a request.
+    Param
+    req: the parsed request
+    Return
+    (str): the api if it is routed, else the kind of request
+    '''
+    api = req.get('Api')
+    # unknown paths share one label, so they cannot grow the metrics
+    return api if api in routes else req.get('Route', 'other')
+
+def count_refusal(req, status):
+    '''
+    Record a request answered without handling it like generate_response
+    does.
+    Param
+    req: the parsed request
+    status: status code and reason
+    '''
+    req['Status'] = status
+    req['Latency'] = 0.0
+    metrics.start()
+    metrics.finish(route_label(req), status, 0.0)
+
+def refuse(req, status):
+    '''
+    Answer a request without handling it, e.g. when the client exceeded
+    its rate limit or the server is overloaded, and record it like
+    generate_response does.
+    Param
+    req: the parsed request
+    status: status code and reason
+    Return
+    (bytes): the error response
+    '''
+    version = req.get('Http-Version')
+    if version not in SUPPORTED_VERSIONS:
+        version = 'HTTP/1.1'
+    count_refusal(req, status)
+    return error_response(status, version, 'keep-alive' if keep_alive(req) else 'close')
+
+def dispatch(req):
+    '''
+    Run the handler of the request.
+    Param
+    req: the parsed request
+    Return
+    (tuple): the status and the response bytes
+    '''
+    connection = 'keep-alive' if keep_alive(req) else 'close'
     if 'Http-Method' not in req:
-        resp['Status-Code'] = '405 Method Not Allowed'
-    elif 'Api' not in req:
-        resp['Status-Code'] = '404 Not Found'
-    elif 'Http-Version' not in req or req['Http-Version'] not in ['HTTP/1.0', 'HTTP/1.1']:
-        resp['Status-Code'] = '505 HTTP Version Not Supported'
+        status = '405 Method Not Allowed'
+        return (status, error_response(status, 'HTTP/1.1', connection))
+    if 'Api' not in req:
+        status = '404 Not Found'
+        return (status, error_response(status, 'HTTP/1.1', connection))
+    version = req.get('Http-Version')
+    if version not in SUPPORTED_VERSIONS:
+        status = '505 HTTP Version Not Supported'
+        return (status, error_response(status, 'HTTP/1.1', connection))
+    handlers = routes.get(req['Api'])
+    if handlers is None:
+        if req['Http-Method'] == 'GET' and DOC_ROOT is not None:
+            return serve_static(req, version, connection)
+        status = '404 Not Found'
+        return (status, error_response(status, version, connection))
+    if req['Http-Method'] not in handlers:
+        status = '405 Method Not Allowed'
+        return (status, error_response(status, version, connection))
+    (handler, content_type, cache_control) = handlers[req['Http-Method']]
+    (status, content) = handler(req)
+    fields = ''
+    if 'ETag' in req:
+        fields += 'ETag: ' + req['ETag'] + '\r\n'
+    if cache_control is not None:
+        fields += 'Cache-Control: ' + cache_control + '\r\n'
+    if status == '304 Not Modified':
+        return (status, f'{version} {status}\r\nConnection: {connection}\r\n{fields}\r\n'.encode('utf8'))
+    if status != '200 OK':
+        return (status, error_response(status, version, connection))
+    # a client streaming its request gets a streamed response back
+    if version == 'HTTP/1.1' and 'transfer-encoding' in req['Headers']:
+        return (status, chunked_response(version, connection, [content], content_type))
+    return (status, ok_response(version, connection, content, accepted_encoding(req), content_type, fields))
+
+@route('POST', '/api/evalexpression')
+def handle_evalexpression(req):
+    if 'Evaluator' in req:
+        # streamed bodies were evaluated on arrival and are not cached
+        evaluation = req['Evaluator'].result()
+        expression = req['Evaluator'].preview()
     else:
-        resp['Http-Version'] = req['Http-Version']
-        resp['Content-Type'] = 'text/html'
-        resp['Api'] = req['Api']
-        if req['Http-Method'] == 'POST':
-            if req['Api'] == '/api/evalexpression':
-                evaluation = get_evaluation(req['Content'])
-                if len(evaluation) > 0:
-                    resp['Content'] = evaluation
-                    resp['Content-Length'] = str(len(evaluation))
-                    update_last_ten_expressions(req['Content'])
-                    update_api_count(req['Api']) 
-                else: 
-                    resp['Status-Code'] = '400 Bad Request'
-            else:
-                resp['Status-Code'] = '404 Not Found'
-        elif req['Http-Method'] == 'GET':
-            if req['Api'] == '/api/gettime':
-                curr_time = get_time()
-                resp['Content'] = curr_time
-                resp['Content-Length'] = str(len(curr_time))
-                update_api_count(req['Api']) 
-            elif req['Api'] == '/status' or req['Api'] == '/status.html':
-                status = get_status()
-                resp['Content'] = status
-                resp['Content-Length'] = str(len(status))
-            else:
-                resp['Status-Code'] = '404 Not Found' 
-        else:
-            resp['Status-Code'] = '404 Not Found'
-    return prepare_response(resp)
+        evaluation = get_evaluation(req.get('Content', ''))
+        expression = req.get('Content')
+    if not evaluation:
+        return ('400 Bad Request', None)
+    update_last_ten_expressions(expression)
+    update_api_count(req['Api'])
+    return ('200 OK', evaluation)
+
+@route('GET', '/api/gettime')
+def handle_gettime(req):
+    update_api_count(req['Api'])
+    return ('200 OK', get_time())
+
+@route('GET', '/status', '/status.html', cache_control=STATUS_CACHE_CONTROL)
+def handle_status(req):
+    (page, etag) = get_status()
+    req['ETag'] = etag
+    if etag_matches(req['Headers'].get('if-none-match'), etag):
+        return ('304 Not Modified', None)
+    return ('200 OK', page)
+
+@route('GET', '/metrics', content_type=CONTENT_TYPES[1])
+def handle_metrics(req):
+    return ('200 OK', metrics.render())
+
+class FileResponse:
+    '''
+    A response whose body is sent from a file with sendfile instead of
+    being read into memory. The file is closed once it was sent.
+    Param
+    head: the status line and headers as bytes
+    file: the open file
+    offset: where the body starts in the file
+    count: the length of the body
+    '''
+
+    def __init__(self, head, file, offset, count):
+        self.head = head
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return len(self.head) + self.count
+
+class FileCache:
+    '''
+    Thread-safe LRU cache of memory-mapped small files, so hot files are
+    served without opening and reading them. An entry is used only while
+    the modification time and size of the file are unchanged, and the
+    mapped bytes never exceed max_bytes.
+    Param
+    max_bytes: byte budget of the mapped files
+    '''
+
+    def __init__(self, max_bytes=STATIC_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # path -> (mtime in ns, size, mmap)
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def read(self, path, stat, start, end):
+        '''
+        Read bytes of a file through the cache.
+        Param
+        path: the real path of the file
+        stat: its os.stat result
+        start: the first byte
+        end: one past the last byte
+        Return
+        (bytes): the bytes from start to end
+        '''
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self.entries.move_to_end(path)
+                # copied under the lock, an evicted map is closed
+                return entry[2][start:end]
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[1]
+                old[2].close()
+            self.entries[path] = (stat.st_mtime_ns, stat.st_size, mapped)
+            self.size += stat.st_size
+            while self.size > self.max_bytes:
+                (old_path, old) = self.entries.popitem(last=False)
+                self.size -= old[1]
+                old[2].close()
+            return mapped[start:end]
+
+# small files served by serve_static
+file_cache = FileCache()
+
+def static_path(api):
+    '''
+    Map a request path to a file under DOC_ROOT.
+    Param
+    api: the request path
+    Return
+    (str): the real path of the file, or None if the path is outside
+    DOC_ROOT or names a hidden file
+    '''
+    parts = unquote(api.split('?', 1)[0]).split('/')
+    # no dot-files such as .git, no '..' out of the root, and no NUL,
+    # which no file name can hold
+    if any(part.startswith('.') or '\0' in part for part in parts):
+        return None
+    root = os.path.realpath(DOC_ROOT)
+    path = os.path.realpath(os.path.join(root, *parts))
+    if os.path.commonpath([root, path]) != root:
+        return None
+    if os.path.isdir(path):
+        path = os.path.join(path, 'index.html')
+    return path
+
+def parse_range(header, size):
+    '''
+    Parse a single byte range of the Range header.
+    Param
+    header: the header value, e.g. 'bytes=0-99'
+    size: the size of the file
+    Return
+    (tuple): the first byte and one past the last, None to send the whole
+    file, or () if the range cannot be satisfied
+    '''
+    unit, _, ranges = header.partition('=')
+    # several ranges may be answered with the whole file
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        if not first:
+            # the last n bytes
+            length = int(last)
+            # an empty file has no last bytes to send
+            if length <= 0 or size == 0:
+                return ()
+            return (max(0, size - length), size)
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    # a last byte before the first makes the header invalid, a first byte
+    # past the end of the file makes the range unsatisfiable
+    if start < 0 or (last and end <= start):
+        return None
+    if start >= size:
+        return ()
+    return (start, min(end, size))
+
+def serve_static(req, version, connection):
+    '''
+    Serve a file under DOC_ROOT, honoring If-Modified-Since and a single
+    byte range. Small files come from the mmap cache, larger ones are sent
+    with sendfile.
+    Param
+    req: the parsed request
+    version: http version of the response
+    connection: 'keep-alive' or 'close'
+    Return
+    (tuple): the status and the response, bytes or a FileResponse
+    '''
+    req['Route'] = 'static'
+    path = static_path(req['Api'])
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        stat = None
+    if stat is None or not S_ISREG(stat.st_mode):
+        status = '404 Not Found'
+        return (status, error_response(status, version, connection))
+    headers = req['Headers']
+    size = stat.st_size
+    last_modified = formatdate(int(stat.st_mtime), usegmt=True)
+    fields = 'Connection: ' + connection + '\r\nLast-Modified: ' + last_modified + '\r\n'
+    # the precondition goes first, an unchanged file is not sent in part
+    # either (RFC 7232 section 6)
+    if 'if-modified-since' in headers:
+        try:
+            since = parsedate_to_datetime(headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and int(stat.st_mtime) <= since:
+            status = '304 Not Modified'
+            return (status, f'{version} {status}\r\n{fields}\r\n'.encode('utf8'))
+    status = '200 OK'
+    (start, end) = (0, size)
+    # If-Range asks for the range only if the file did not change
+    if 'range' in headers and headers.get('if-range', last_modified) == last_modified:
+        byte_range = parse_range(headers['range'], size)
+        if byte_range == ():
+            status = '416 Range Not Satisfiable'
+            fields += f'Content-Range: bytes */{size}\r\nContent-Length: 0\r\n'
+            return (status, f'{version} {status}\r\n{fields}\r\n'.encode('utf8'))
+        if byte_range is not None:
+            status = '206 Partial Content'
+            (start, end) = byte_range
+            fields += f'Content-Range: bytes {start}-{end - 1}/{size}\r\n'
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    fields += f'Content-Type: {content_type}\r\nAccept-Ranges: bytes\r\nContent-Length: {end - start}\r\n'
+    head = f'{version} {status}\r\n{fields}\r\n'.encode('utf8')
+    if size == 0:
+        return (status, head)
+    if size <= STATIC_MMAP_MAX_SIZE:
+        return (status, head + file_cache.read(path, stat, start, end))
+    return (status, FileResponse(head, open(path, 'rb'), start, end - start))
 
 def prepare_response(resp):
     '''
@@ -139,15 +1449,34 @@ def prepare_response(resp):
     (bytes): the http response
     '''
     ans = prepare_header(resp)
+    ans += 'Connection: '
+    ans += resp['Connection']
+    ans += '\r\n'
     if resp['Status-Code'] == '200 OK': 
-        ans += 'Content-Type: text/html'
+        ans += 'Content-Type: '
+        ans += resp.get('Content-Type', CONTENT_TYPES[0])
         ans += '\r\n'
+        if 'Content-Encoding' in resp:
+            ans += 'Content-Encoding: '
+            ans += resp['Content-Encoding']
+            ans += '\r\n'
+        if 'Vary' in resp:
+            ans += 'Vary: '
+            ans += resp['Vary']
+            ans += '\r\n'
         ans += 'Content-Length: '
         ans += resp['Content-Length']
         ans += '\r\n'
         ans += '\r\n'
-        ans += resp['Content']
+        content = resp['Content']
+        if isinstance(content, str):
+            content = content.encode('utf8')
+        return ans.encode('utf8') + content
     else:
+        # an empty body must be framed too, or a persistent connection
+        # could not tell where the next response starts
+        ans += 'Content-Length: 0'
+        ans += '\r\n'
         ans += '\r\n'
     return ans.encode('utf8')
 
@@ -159,22 +1488,297 @@ def prepare_header(resp):
     Return
     (str): the http response header
     '''
-    header = ''
-    if 'Http-Version' in resp:
-        header += resp['Http-Version']
-        header += ' '
+    header = resp.get('Http-Version', 'HTTP/1.1')
+    header += ' '
     header += resp['Status-Code']
     header += '\r\n'
     return header
 
+def ok_response(version, connection, content, encoding=None, content_type=CONTENT_TYPES[0], fields=''):
+    '''
+    Prepare a 200 response from the pre-encoded headers of its version,
+    connection and content type. Content of at least COMPRESS_MIN_SIZE
+    bytes is compressed with the given encoding and marked as varying with
+    Accept-Encoding.
+    Param
+    version: http version of the response
+    connection: 'keep-alive' or 'close'
+    content: the body, as str or bytes; bytes are taken to be reused
+    between requests and their compressed form is cached
+    encoding: content coding accepted by the client, or None
+    content_type: the content type of the body
+    fields: more header lines, each ending with CRLF
+    Return
+    (bytes): the http response
+    '''
+    cacheable = isinstance(content, bytes)
+    if not cacheable:
+        content = content.encode('utf8')
+    if len(content) < COMPRESS_MIN_SIZE:
+        coding = None
+    elif encoding is None:
+        coding = 'identity'
+    else:
+        content = compress_content(content, encoding, cacheable)
+        coding = encoding
+    head = ok_heads.get((version, connection, coding, content_type))
+    if head is None:
+        resp = {'Http-Version': version, 'Status-Code': '200 OK', 'Connection': connection,
+                'Content-Type': content_type, 'Content-Length': str(len(content)), 'Content': content}
+        if coding is not None:
+            resp['Vary'] = 'Accept-Encoding'
+        if coding in SUPPORTED_ENCODINGS:
+            resp['Content-Encoding'] = encoding
+        return add_fields(prepare_response(resp), fields)
+    return add_fields(head, fields) + b'%d\r\n\r\n' % len(content) + content
+
+def add_fields(head, fields):
+    '''
+    Insert header lines right after the status line.
+    Param
+    head: the encoded response head
+    fields: the header lines, each ending with CRLF
+    Return
+    (bytes): the head with the lines
+    '''
+    if not fields:
+        return head
+    i = head.index(b'\r\n') + 2
+    return head[:i] + fields.encode('utf8') + head[i:]
+
+def chunked_response(version, connection, pieces, content_type=CONTENT_TYPES[0]):
+    '''
+    Prepare a 200 response with chunked transfer encoding.
+    Param
+    version: http version of the response, HTTP/1.1
+    connection: 'keep-alive' or 'close'
+    pieces: the body as an iterable of str or bytes, one chunk each
+    content_type: the content type of the body
+    Return
+    (bytes): the http response
+    '''
+    resp = [(version + ' 200 OK\r\nConnection: ' + connection + '\r\nContent-Type: ' + content_type
+             + '\r\nTransfer-Encoding: chunked\r\n\r\n').encode('utf8')]
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode('utf8')
+        # an empty chunk would end the body early
+        if piece:
+            resp.append(b'%x\r\n' % len(piece) + piece + b'\r\n')
+    resp.append(b'0\r\n\r\n')
+    return b''.join(resp)
+
+def error_response(status, version='HTTP/1.1', connection='close'):
+    '''
+    Get the response to a failed request, pre-encoded for the common cases.
+    Param
+    status: status code and reason
+    version: http version of the response
+    connection: 'keep-alive' or 'close'
+    Return
+    (bytes): the http response
+    '''
+    resp = error_responses.get((status, version, connection))
+    if resp is None:
+        resp = prepare_response({'Http-Version': version, 'Status-Code': status, 'Connection': connection})
+    return resp
+
+def prepare_constant_responses():
+    '''
+    Encode the 200 headers and the error responses once at startup.
+    Return
+    (tuple): 200 header prefixes keyed by (version, connection, coding,
+    content type) and error responses keyed by (status, version, connection)
+    '''
+    heads, errors = {}, {}
+    for version in SUPPORTED_VERSIONS:
+        for connection in ('keep-alive', 'close'):
+            # None for short content, 'identity' for compressible content
+            # sent as it is, else the content coding used
+            for coding in (None, 'identity') + SUPPORTED_ENCODINGS:
+                for content_type in CONTENT_TYPES:
+                    head = (version + ' 200 OK\r\nConnection: ' + connection
+                            + '\r\nContent-Type: ' + content_type + '\r\n')
+                    if coding in SUPPORTED_ENCODINGS:
+                        head += 'Content-Encoding: ' + coding + '\r\n'
+                    if coding is not None:
+                        head += 'Vary: Accept-Encoding\r\n'
+                    heads[(version, connection, coding, content_type)] = (head + 'Content-Length: ').encode('utf8')
+            for status in ('400 Bad Request', '404 Not Found', '405 Method Not Allowed', '413 Content Too Large',
+                           '500 Internal Server Error', '501 Not Implemented', '505 HTTP Version Not Supported'):
+                errors[(status, version, connection)] = prepare_response(
+                    {'Http-Version': version, 'Status-Code': status, 'Connection': connection})
+            # refused requests may be sent again after a second
+            for status in ('429 Too Many Requests', '503 Service Unavailable'):
+                errors[(status, version, connection)] = add_fields(prepare_response(
+                    {'Http-Version': version, 'Status-Code': status, 'Connection': connection}), 'Retry-After: 1\r\n')
+    return (heads, errors)
+
+(ok_heads, error_responses) = prepare_constant_responses()
+
+def accepted_encoding(req):
+    '''
+    Pick the content coding of the response from the Accept-Encoding
+    header of the request.
+    Param
+    req: the parsed request
+    Return
+    (str): 'gzip' or 'deflate', or None to send the content as it is
+    '''
+    header = req['Headers'].get('accept-encoding')
+    if not header:
+        return None
+    return parse_accept_encoding(header)
+
+@lru_cache(maxsize=256)
+def parse_accept_encoding(header):
+    '''
+    Parse an Accept-Encoding value; clients send only a few distinct
+    values, so the results are memoized.
+    Param
+    header: the header value
+    Return
+    (str): the supported coding with the highest q-value, ties going to the
+    order of SUPPORTED_ENCODINGS, or None if none is acceptable
+    '''
+    weights = {}
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        weight = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    best, best_weight = None, 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+def compress_content(content, encoding, cacheable):
+    '''
+    Compress the content with the given coding.
+    Param
+    content: the body as bytes
+    encoding: 'gzip' or 'deflate'
+    cacheable: whether the content is reused between requests, in which
+    case its compressed form is cached
+    Return
+    (bytes): the compressed body
+    '''
+    if cacheable:
+        val = compressed_cache[encoding].get(content)
+        if val is not None:
+            return val
+    if encoding == 'gzip':
+        # a fixed mtime keeps the output identical for identical content
+        val = gzip.compress(content, COMPRESS_LEVEL, mtime=0)
+    else:
+        # 'deflate' in HTTP is the zlib format
+        val = zlib.compress(content, COMPRESS_LEVEL)
+    if cacheable:
+        compressed_cache[encoding].put(content, val)
+    return val
+
+class ExpressionCache:
+    '''
+    Thread-safe LRU cache of evaluation results keyed on the normalized
+    expression. Keys and values together never take more than max_bytes;
+    the least recently used entries are evicted first.
+    '''
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''
+        Look up a cached result, marking it as recently used.
+        Param
+        key: normalized expression
+        Return
+        the cached result, or None on a miss
+        '''
+        with self.lock:
+            val = self.entries.get(key)
+            if val is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        '''
+        Store a result, evicting old entries to stay within the byte budget.
+        Param
+        key: normalized expression
+        val: its evaluation
+        '''
+        cost = len(key) + len(val)
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(key) + len(old)
+            self.entries[key] = val
+            self.size += cost
+            while self.size > self.max_bytes:
+                old_key, old_val = self.entries.popitem(last=False)
+                self.size -= len(old_key) + len(old_val)
+
+    def stats(self):
+        '''
+        Return
+        (tuple): hits, misses, entries and bytes used
+        '''
+        with self.lock:
+            return (self.hits, self.misses, len(self.entries), self.size)
+
+# evaluation results shared by all handler threads
+evaluation_cache = ExpressionCache()
+
+# compressed forms of reusable responses such as the /status page, keyed
+# on their content; the LRU works the same for any bytes keys
+compressed_cache = {encoding: ExpressionCache(COMPRESS_CACHE_MAX_BYTES) for encoding in SUPPORTED_ENCODINGS}
+
 def get_evaluation(expression):
     '''
-    Evaluate the given expression
+    Evaluate the given expression, reusing the cached result if the same
+    expression was evaluated before.
     Param
     expression: math expression
     Return
     (str): evaluation result
     '''
+    if not expression:
+        return ''
+    key = expression.strip()
+    val = evaluation_cache.get(key)
+    if val is None:
+        val = evaluate_expression(key)
+        evaluation_cache.put(key, val)
+    return val
+
+def evaluate_expression(expression):
+    '''
+    Evaluate the given expression
+    Param
+    expression: math expression
+    Return
+    (str): evaluation result, or '' if the expression is invalid
+    '''
     if not expression:
         return ''
     items = list(expression.strip())
@@ -193,6 +1797,78 @@ def get_evaluation(expression):
         i += 1
     return str(val)
 
+# a signed term of an expression holding only digits and '+' '-'; a run
+# of operators counts as its last one, as in evaluate_expression
+term_pattern = re.compile(rb'[+-]?[0-9]+')
+expression_bytes = b'0123456789+-'
+
+class StreamEvaluator:
+    '''
+    Evaluate an expression incrementally as its bytes arrive, with the
+    same result as evaluate_expression on the whole of it. Only the running
+    value, the term cut by the last piece and a short preview are kept, so
+    memory does not grow with the length of the expression.
+    '''
+
+    def __init__(self):
+        self.val = 0
+        self.pending = b''
+        self.head = b''
+        self.size = 0
+        self.valid = True
+        # whether the expression started, and whether whitespace after it
+        # was seen, which only more whitespace may follow
+        self.started = False
+        self.ended = False
+
+    def feed(self, piece):
+        '''
+        Add the next piece of the expression.
+        Param
+        piece: the next bytes of the expression
+        '''
+        if not self.valid:
+            return
+        stripped = piece.strip()
+        if not stripped:
+            self.ended = self.started
+            return
+        if self.ended or (self.started and stripped[0] != piece[0]) \
+                or stripped.translate(None, expression_bytes):
+            self.valid = False
+            return
+        self.started = True
+        self.ended = stripped[-1] != piece[-1]
+        if len(self.head) < STREAM_PREVIEW_SIZE:
+            self.head += stripped[:STREAM_PREVIEW_SIZE - len(self.head)]
+        self.size += len(stripped)
+        data = self.pending + stripped
+        # every term before the last operator is complete
+        cut = max(data.rfind(b'+'), data.rfind(b'-'))
+        if cut > 0:
+            self.val += sum(map(int, term_pattern.findall(data[:cut])))
+            data = data[cut:]
+        self.pending = data
+
+    def result(self):
+        '''
+        Return
+        (str): evaluation result, or '' if the expression is invalid
+        '''
+        if not self.valid or not self.started:
+            return ''
+        return str(self.val + sum(map(int, term_pattern.findall(self.pending))))
+
+    def preview(self):
+        '''
+        Return
+        (str): the start of the expression, for the /status page
+        '''
+        expression = self.head.decode('utf8')
+        if self.size > len(self.head):
+            expression += '...'
+        return expression
+
 def get_time():
     '''
     Get the current time in a better format.
@@ -201,17 +1877,103 @@ def get_time():
     '''
     return now().strftime("%d/%m/%Y %H:%M:%S")
 
+class StatusPage:
+    '''
+    Render cache of the /status page. The page is kept as encoded bytes
+    built from one fragment per API and one for the last ten expressions.
+    A fragment is re-rendered only when its counts or expressions change,
+    and the page is re-assembled only if a fragment changed. Within max_staleness seconds
+    of the last render the cached bytes are returned without any check.
+    The ETag of the page is hashed from its content once per re-assembly,
+    so every prefork worker gives the same page the same tag.
+    Param
+    max_staleness: seconds the page may lag behind the counters
+    '''
+
+    def __init__(self, max_staleness=STATUS_MAX_STALENESS):
+        self.max_staleness = max_staleness
+        self.lock = threading.Lock()
+        self.prefix = ('<!DOCTYPE html><html>' + get_head() + '<body>'
+                       + wrap_with_tag('API count information', 'h1')).encode('utf8')
+        self.suffix = b'</body></html>'
+        # api -> (counts, fragment bytes)
+        self.api_fragments = {}
+        # the expressions the last ten fragment was rendered from
+        self.last_ten = None
+        self.last_ten_fragment = None
+        self.page = None
+        self.etag = None
+        self.rendered_at = 0
+
+    def render(self):
+        '''
+        Return
+        (tuple): the current status page and its ETag
+        '''
+        with self.lock:
+            curr_time = time.monotonic()
+            if self.page is not None and curr_time - self.rendered_at < self.max_staleness:
+                return (self.page, self.etag)
+            changed = self.page is None
+            for api, counter in api_count.items():
+                counts = counter.counts()
+                cached = self.api_fragments.get(api)
+                if cached is None or cached[0] != counts:
+                    fragment = get_single_api_count(api, counts).encode('utf8')
+                    self.api_fragments[api] = (counts, fragment)
+                    changed = True
+            # a snapshot also sees expressions added by other prefork workers
+            last_ten = last_ten_expressions.snapshot()
+            if last_ten != self.last_ten:
+                self.last_ten_fragment = get_last_ten_expressions(last_ten).encode('utf8')
+                self.last_ten = last_ten
+                changed = True
+            if changed:
+                self.page = b''.join([self.prefix]
+                                     + [self.api_fragments[api][1] for api in api_count]
+                                     + [self.last_ten_fragment, self.suffix])
+                self.etag = get_etag(self.page)
+            self.rendered_at = curr_time
+            return (self.page, self.etag)
+
 def get_status():
     '''
     Get the status of the http server
     Return
-    (str): an html page shows the status of the server
+    (tuple): an html page shows the status of the server, as bytes, and
+    its ETag
     '''
-    status = '<!DOCTYPE html>'
-    head = get_head()
-    body = get_body()
-    status += wrap_with_tag(head + body, 'html')
-    return status
+    return status_page.render()
+
+def get_etag(content):
+    '''
+    Get the ETag of a content.
+    Param
+    content: the content as bytes
+    Return
+    (str): a weak ETag, as the compressed forms of the content share it
+    '''
+    return 'W/"' + hashlib.blake2b(content, digest_size=8).hexdigest() + '"'
+
+def etag_matches(header, etag):
+    '''
+    Check an If-None-Match header against an ETag with the weak comparison.
+    Param
+    header: the header value, or None if it was not sent
+    etag: the current ETag
+    Return
+    (bool): whether the client has the current content
+    '''
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith('W/') else tag) == etag:
+            return True
+    return False
 
 def update_last_ten_expressions(expression):
     '''
@@ -219,11 +1981,7 @@ def update_last_ten_expressions(expression):
     Param
     expression: the last ten expressions
     '''
-    if expression in last_ten_expressions:
-        last_ten_expressions.remove(expression)
-    last_ten_expressions.append(expression)
-    if len(last_ten_expressions) > 10:
-        last_ten_expressions.pop(0)
+    last_ten_expressions.add(expression)
 
 def update_api_count(api):
     '''
@@ -231,35 +1989,18 @@ def update_api_count(api):
     Param
     api: the api to be updated
     '''
-    api_count[api].append(now())
-
-def get_api_count(api_count):
-    '''
-    Get all the api count info
-    Param
-    api_count: api count info
-    Return
-    (str): the api count part of the status html page
-    '''
-    ans = wrap_with_tag('API count information', 'h1')
-    lis = ''
-    for key, value in api_count.items():
-        lis += get_single_api_count(key, value)
-    ans += lis
-    return ans
+    api_count[api].add()
 
-def get_single_api_count(api, count):
+def get_single_api_count(api, nums):
     '''
     Get a api count info
     Param
     api: name of api
-    count: list of datetime objects of the api that was called
+    nums: counts of the api for each duration, see SlidingCounter.counts
     Return
     (str): single api info part on the html page
     '''
     ans = wrap_with_tag(api, 'h3')
-    curr_time = now()
-    nums = get_num(count, curr_time)
     items = ['last minute', 'last hour', 'last 24 hours', 'lifetime']
     lis = ''
     for i in range(len(nums)):
@@ -267,38 +2008,18 @@ def get_single_api_count(api, count):
     ans += wrap_with_tag(lis, 'ul')
     return ans
 
-def get_num(list_datetime, now):
-    '''
-    Get the number of datetimes between each specified duration.
-    Param
-    list_datetime: list of datetime objects
-    now: current datetime
-    Return
-    (tuple): number for each specified duration 
-    '''
-    last_min, last_hour, last_24_hours, lifetime = 0, 0, 0, 0
-    for date in list_datetime:
-        duration_in_seconds = (now - date).total_seconds()
-        if duration_in_seconds < 60:
-            last_min += 1
-        if duration_in_seconds < 60 * 60:
-            last_hour += 1
-        if duration_in_seconds < 24 * 60 * 60:
-            last_24_hours += 1
-        lifetime += 1
-    return (last_min, last_hour, last_24_hours, lifetime)
-
 def get_last_ten_expressions(last_ten_expressions):
     '''
     Get the last ten expressions
     Param:
-    last_ten_expressions: last ten expressions http server had evaluated
+    last_ten_expressions: last ten expressions http server had evaluated,
+    most recent first
     Return
     (str): last ten expressions info for the status html page
     '''
     ans = wrap_with_tag('Last 10 expressions', 'h1')
     lis = ''
-    for expression in last_ten_expressions[::-1]:
+    for expression in last_ten_expressions:
         lis += wrap_with_tag(expression, 'li')
     ans += wrap_with_tag(lis, 'ul')
     return ans
@@ -325,12 +2046,174 @@ def get_head():
     '''
     return wrap_with_tag(wrap_with_tag('HttpServer Status', 'title'), 'head')
 
-def get_body():
+class MetricsShard:
     '''
-    Get the body for the status html page
+    Metrics recorded by the threads of one shard.
     '''
-    api_count_info = get_api_count(api_count)
-    expressions_info = get_last_ten_expressions(last_ten_expressions)
-    return wrap_with_tag(api_count_info + expressions_info, 'body')
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (route, code) -> count
+        self.requests = defaultdict(int)
+        # route -> [count per bucket and one past the last, sum, count]
+        self.latency = {}
+        self.in_flight = 0
+
+class Metrics:
+    '''
+    Request metrics in Prometheus text format: requests per route and
+    status code, a latency histogram per route and the number of requests
+    being handled. Latency is the time taken to produce the response.
+    Each thread records into one of COUNTER_SHARDS shards, which are
+    merged when the metrics are rendered.
+    '''
+
+    # upper bounds of the latency buckets in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self):
+        self.shards = [MetricsShard() for i in range(COUNTER_SHARDS)]
+
+    def start(self):
+        '''
+        Count a request as being handled.
+        '''
+        shard = self.shards[shard_index()]
+        with shard.lock:
+            shard.in_flight += 1
+
+    def finish(self, route, status, seconds):
+        '''
+        Record a handled request.
+        Param
+        route: the route label
+        status: status code and reason
+        seconds: the time taken
+        '''
+        i = bisect_left(self.BUCKETS, seconds)
+        shard = self.shards[shard_index()]
+        with shard.lock:
+            # a request finishing on another thread than it started on
+            # only moves the gauge between shards, the total stays right
+            shard.in_flight -= 1
+            shard.requests[(route, status.split(' ', 1)[0])] += 1
+            hist = shard.latency.get(route)
+            if hist is None:
+                hist = shard.latency[route] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            hist[0][i] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    def render(self):
+        '''
+        Return
+        (str): the metrics in Prometheus text format
+        '''
+        merged_requests = defaultdict(int)
+        merged_latency = {}
+        in_flight = 0
+        for shard in self.shards:
+            with shard.lock:
+                for key, count in shard.requests.items():
+                    merged_requests[key] += count
+                for route, (buckets, total, count) in shard.latency.items():
+                    hist = merged_latency.setdefault(route, [[0] * len(buckets), 0.0, 0])
+                    hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+                    hist[1] += total
+                    hist[2] += count
+                in_flight += shard.in_flight
+        requests = sorted(merged_requests.items())
+        latency = sorted(merged_latency.items())
+        lines = ['# HELP http_requests_total Requests handled, by route and status code.',
+                 '# TYPE http_requests_total counter']
+        for (route, code), count in requests:
+            lines.append(f'http_requests_total{{route="{route}",code="{code}"}} {count}')
+        lines.append('# HELP http_request_duration_seconds Time taken to produce the response.')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for route, (buckets, total, count) in latency:
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'http_request_duration_seconds_sum{{route="{route}"}} {total}')
+            lines.append(f'http_request_duration_seconds_count{{route="{route}"}} {count}')
+        lines.append('# HELP http_requests_in_flight Requests being handled.')
+        lines.append('# TYPE http_requests_in_flight gauge')
+        lines.append(f'http_requests_in_flight {in_flight}')
+        return '\n'.join(lines) + '\n'
+
+class RequestLog:
+    '''
+    Request logger that never blocks the request: entries are queued and
+    formatted and written by a background thread in batches. Only one in
+    sample requests is logged, and a disabled log drops every entry.
+    Param
+    enabled: whether anything is logged
+    sample: log one request in this many
+    '''
+
+    def __init__(self, enabled=LOG_REQUESTS, sample=LOG_SAMPLE):
+        self.enabled = enabled
+        self.sample = sample
+        self.counter = itertools.count()
+        if enabled:
+            self.start()
+            # threads do not survive fork, prefork workers need their own
+            os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        '''
+        Start the writing thread with an empty queue.
+        '''
+        self.entries = queue.SimpleQueue()
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def request(self, addr, req, resp):
+        '''
+        Log a handled request if it is sampled.
+        Param
+        addr: the client address
+        req: the request, after generate_response
+        resp: the response bytes
+        '''
+        # next on an itertools counter is atomic, no lock needed
+        if self.enabled and next(self.counter) % self.sample == 0:
+            self.entries.put((addr, req, len(resp)))
+
+    def error(self, *args):
+        '''
+        Log a message, bypassing the sampling.
+        '''
+        if self.enabled:
+            self.entries.put(' '.join(str(arg) for arg in args))
+
+    def write(self):
+        while True:
+            lines = [self.entries.get()]
+            while len(lines) < LOG_BATCH and not self.entries.empty():
+                lines.append(self.entries.get())
+            sys.stdout.write(''.join(format_log_entry(entry) + '\n' for entry in lines))
+            sys.stdout.flush()
+
+def format_log_entry(entry):
+    '''
+    Format a log entry as one line.
+    Param
+    entry: (address, request, response length), or a message
+    Return
+    (str): the log line
+    '''
+    if isinstance(entry, str):
+        return entry
+    (addr, req, resp_len) = entry
+    return '{}:{} "{} {} {}" {} {} {:.3f}ms'.format(
+        addr[0], addr[1], req.get('Http-Method', '-'), req.get('Api', '-'), req.get('Http-Version', '-'),
+        req.get('Status', '-').split(' ', 1)[0], resp_len, req.get('Latency', 0) * 1e3)
 
+# the /status page, re-rendered only where the server state changed
+status_page = StatusPage()
+# request metrics served at /metrics
+metrics = Metrics()
+request_log = RequestLog()
+rate_limiter = RateLimiter()
@@ -4,7 +4,37 @@
 
 WEB_API_SERVER = 'localhost'
 WEB_API_PORT = 8180
+# worker processes of the web api server, 0 serves from a single process
+WEB_API_WORKERS = 0
+WEB_API_RESTART_DELAY = 1
+# the status page carries an ETag; clients must check it is still current
+STATUS_CACHE_CONTROL = 'no-cache'
+# per-client rate limit of the web api server: a client address gets
+# WEB_API_RATE_BURST tokens to start with and WEB_API_RATE_LIMIT more per
+# second, a request costs one token plus one per WEB_API_RATE_COST_BYTES of
+# its body and is answered with 429 when the tokens run out, or with 413 when
+# its body costs more than WEB_API_RATE_BURST; 0 turns it off
+WEB_API_RATE_LIMIT = 200
+WEB_API_RATE_BURST = 400
+WEB_API_RATE_COST_BYTES = 1024
+WEB_API_RATE_LIMIT_CLIENTS = 64 * 1024
+WEB_API_RATE_LIMIT_SHARDS = 16
+# requests handled at once, requests waiting for them at most and the
+# seconds they may wait; requests beyond them are answered with 503
+WEB_API_HANDLERS = 16
+WEB_API_QUEUE_MAX = 256
+WEB_API_QUEUE_DEADLINE = 1
 EXPRESSION_EVAL_SERVER = 'localhost'
 EXPRESSION_EVAL_PORT = 8181
 CACHE_SERVER = 'localhost'
-CACHE_PORT = 8182
\ No newline at end of file
+CACHE_PORT = 8182
+# check-and-set attempts of a worker updating the last ten expressions
+# while others do too, and the characters kept of each of them
+CACHE_CAS_ATTEMPTS = 16
+LAST_EXPRESSION_MAX_CHARS = 256
+EVAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+EVAL_PROCESSES = 0
+# expressions at least this long go to the process pool; the eval server
+# frames them with a 16-bit length, so this must stay below 32767 bytes,
+# and shorter ones cost less to evaluate inline than to send to a worker
+EVAL_INLINE_MAX_BYTES = 2 * 1024
@@ -7,6 +7,10 @@ import threading
 import utils
 import config
 
+# evaluate large expressions on worker processes
+if config.EVAL_PROCESSES > 0:
+    utils.start_eval_pool(config.EVAL_PROCESSES)
+
 server_ip = socket.gethostbyname(config.EXPRESSION_EVAL_SERVER)
 # create a new socket object
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -2,12 +2,16 @@
 # Author: Yuanjie Yue
 # Date: 10/16/2019
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import config
+import hashlib
+import multiprocessing
 import socket
 import struct
-
-MAX_BUFF_SIZE = 16
+import threading
+import time
 
 def now():
     '''
@@ -32,11 +36,14 @@ def io_read_n_bytes(io, n):
     Return
     (bytes) the bytes data
     '''
-    data = bytearray()
-    while len(data) < n:
-        remain_len = n - len(data)
-        buff_size = min(MAX_BUFF_SIZE, remain_len)
-        data += io.read(buff_size)
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        curr_len = io.readinto(view[received:])
+        if not curr_len:
+            raise ConnectionError('stream closed before all data arrived')
+        received += curr_len
     return bytes(data)
 
 def socket_read_n_bytes(conn, n):
@@ -48,21 +55,220 @@ def socket_read_n_bytes(conn, n):
     Return
     (bytes) the bytes data
     '''
-    data = bytearray()
-    while len(data) < n:
-        remain_len = n - len(data)
-        buff_size = min(MAX_BUFF_SIZE, remain_len)
-        data += conn.recv(buff_size)
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        curr_len = conn.recv_into(view[received:])
+        if curr_len == 0:
+            raise ConnectionError('connection closed by peer')
+        received += curr_len
     return bytes(data)
 
+class ExpressionCache:
+    '''
+    Thread-safe LRU cache of evaluation results keyed on the normalized
+    expression. Keys and values together never take more than max_bytes;
+    the least recently used entries are evicted first.
+    '''
+
+    def __init__(self, max_bytes=config.EVAL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''
+        Look up a cached result, marking it as recently used.
+        Param
+        key: normalized expression
+        Return
+        the cached result, or None on a miss
+        '''
+        with self.lock:
+            val = self.entries.get(key)
+            if val is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        '''
+        Store a result, evicting old entries to stay within the byte budget.
+        Param
+        key: normalized expression
+        val: its evaluation
+        '''
+        cost = len(key) + len(val)
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(key) + len(old)
+            self.entries[key] = val
+            self.size += cost
+            while self.size > self.max_bytes:
+                old_key, old_val = self.entries.popitem(last=False)
+                self.size -= len(old_key) + len(old_val)
+
+    def stats(self):
+        '''
+        Return
+        (tuple): hits, misses, entries and bytes used
+        '''
+        with self.lock:
+            return (self.hits, self.misses, len(self.entries), self.size)
+
+# evaluation results shared by all handler threads
+evaluation_cache = ExpressionCache()
+
+class RateLimiter:
+    '''
+    Per-client token buckets. The buckets are spread over several locks by
+    client address, so concurrent handlers rarely wait for each other, and
+    a shard forgets the clients it saw first once it holds its part of
+    max_clients.
+    Param
+    rate: tokens added per second, 0 lets every request through
+    burst: tokens a bucket holds at most
+    max_clients: clients tracked at most
+    shards: the number of locks
+    '''
+
+    def __init__(self, rate, burst, max_clients, shards):
+        self.rate = rate
+        self.burst = burst
+        self.shard_size = max(1, max_clients // shards)
+        # client -> (tokens, monotonic time of the last update) per shard
+        self.shards = [(threading.Lock(), {}) for i in range(shards)]
+
+    def allow(self, client, cost=1):
+        '''
+        Take tokens from the bucket of a client.
+        Param
+        client: the client address
+        cost: the tokens the request costs
+        Return
+        (bool): whether the request may be handled
+        '''
+        if self.rate <= 0:
+            return True
+        (lock, buckets) = self.shards[hash(client) % len(self.shards)]
+        curr_time = time.monotonic()
+        with lock:
+            bucket = buckets.get(client)
+            if bucket is None:
+                if len(buckets) >= self.shard_size:
+                    del buckets[next(iter(buckets))]
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (curr_time - bucket[1]) * self.rate)
+            allowed = tokens >= cost
+            buckets[client] = (tokens - cost if allowed else tokens, curr_time)
+            return allowed
+
+class Admission:
+    '''
+    Bounded admission of requests to their handlers: at most slots run at
+    once and at most queue_size wait for a slot. A request finding the
+    queue full, or waiting longer than deadline seconds, is refused, since
+    it would be answered later than its client is likely to wait.
+    Param
+    slots: handlers running at once
+    queue_size: requests waiting at most
+    deadline: seconds a request may wait
+    '''
+
+    def __init__(self, slots, queue_size, deadline):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.running = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def enter(self):
+        '''
+        Wait for a slot.
+        Return
+        (bool): True if the request got a slot and must call leave
+        '''
+        with self.cond:
+            if self.running < self.slots:
+                self.running += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                admitted = self.cond.wait_for(lambda: self.running < self.slots, self.deadline)
+            finally:
+                self.waiting -= 1
+            if admitted:
+                self.running += 1
+            return admitted
+
+    def leave(self):
+        '''
+        Give the slot back.
+        '''
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+# worker processes for large expressions, see start_eval_pool
+eval_pool = None
+
+def start_eval_pool(processes):
+    '''
+    Evaluate expressions of at least EVAL_INLINE_MAX_BYTES on a pool of
+    worker processes, so handler threads are not bound to one core by the
+    GIL. Smaller ones stay inline, where they cost less than the IPC.
+    Param
+    processes: number of worker processes
+    '''
+    global eval_pool
+    # the server scripts run at import time, so workers are forked rather
+    # than spawned by importing the main module again
+    eval_pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+    # fork every worker now, before the server starts any thread
+    eval_pool.submit(evaluate_expression, '').result()
+
 def get_evaluation(expression):
     '''
-    Evaluate the given expression
+    Evaluate the given expression, reusing the cached result if the same
+    expression was evaluated before.
     Param
     expression: math expression
     Return
     (str): evaluation result
     '''
+    if not expression:
+        return ''
+    key = expression.strip()
+    val = evaluation_cache.get(key)
+    if val is None:
+        if eval_pool is not None and len(key) >= config.EVAL_INLINE_MAX_BYTES:
+            val = eval_pool.submit(evaluate_expression, key).result()
+        else:
+            val = evaluate_expression(key)
+        evaluation_cache.put(key, val)
+    return val
+
+def evaluate_expression(expression):
+    '''
+    Evaluate the given expression
+    Param
+    expression: math expression
+    Return
+    (str): evaluation result, or '' if the expression is invalid
+    '''
     if not expression:
         return ''
     items = list(expression.strip())
@@ -119,37 +325,79 @@ def write_expression(conn, expr):
     conn.sendall(struct.pack('!h', len(expr)))
     conn.sendall(expr)
 
+# the api counts are kept in memcache buckets, one key per api, bucket
+# width and bucket index, so every worker adds to them with an atomic incr:
+# (label, bucket width in seconds, buckets summed) per reported window.
+# The last minute is exact to the second, the last hour to the minute and
+# the last 24 hours to ten minutes
+API_COUNT_WINDOWS = (
+    ('last minute', 1, 60),
+    ('last hour', 60, 60),
+    ('last 24 hours', 600, 144),
+)
+
+def api_count_key(api, width, bucket):
+    '''
+    Get the memcache key of one bucket of an api count.
+    Param
+    api: name of api
+    width: bucket width in seconds, 0 for the lifetime count
+    bucket: index of the bucket since the epoch
+    '''
+    if not width:
+        return api + ':lifetime'
+    return f'{api}:{width}:{bucket}'
+
+def cache_incr(cache, key, expire=0):
+    '''
+    Add one to a counter in memcache, creating it if it does not exist.
+    Param
+    cache: memory cache
+    key: the key of the counter
+    expire: seconds the counter is kept once created, 0 for ever
+    '''
+    if cache.incr(key, 1, noreply=False) is not None:
+        return
+    # another worker may create the counter first, then it is incremented
+    if not cache.add(key, b'1', expire=expire, noreply=False):
+        cache.incr(key, 1, noreply=False)
+
 def update_api_count(cache, key):
     '''
     Update the api count of the server.
     Param
     cache: memory cache
-    api: the api to be updated
+    key: the api to be updated
     '''
-    val = cache.get(key, default=b'').decode()
-    if val:
-        val += ',' 
-    val += get_time()
-    cache.set(key, val)
+    curr_time = int(time.time())
+    for (label, width, buckets) in API_COUNT_WINDOWS:
+        # a bucket is kept until it drops out of its window
+        cache_incr(cache, api_count_key(key, width, curr_time // width), width * (buckets + 1))
+    cache_incr(cache, api_count_key(key, 0, 0))
 
 def update_last_ten_expressions(cache, key, expr):
     '''
-    Update the last ten expressions.
+    Update the last ten expressions. Workers may update them at once, so
+    the value is replaced with a check-and-set and retried if another
+    worker replaced it first; an expression is cut to
+    config.LAST_EXPRESSION_MAX_CHARS so the value stays small.
     Param
     cache: memory cache
     key: the key of the last ten expressions
     expr: the latest expr
     '''
-    val = cache.get(key, default=b'').decode()
-    if not val:
-        val += expr
-    else: 
-        exprs = val.split(',')
+    if len(expr) > config.LAST_EXPRESSION_MAX_CHARS:
+        expr = expr[:config.LAST_EXPRESSION_MAX_CHARS] + '...'
+    for attempt in range(config.CACHE_CAS_ATTEMPTS):
+        (val, token) = cache.gets(key)
+        exprs = val.decode().split(',') if val else []
         exprs.append(expr)
-        if len(exprs) > 10:
-            exprs.pop(0)
-        val = ','.join(exprs)
-    cache.set(key, val)
+        val = ','.join(exprs[-10:]).encode()
+        if token is None:
+            if cache.add(key, val, noreply=False):
+                return
+        elif cache.cas(key, val, token, noreply=False):
+            return
 
 def get_status(cache):
     '''
@@ -163,6 +411,36 @@ def get_status(cache):
     status += wrap_with_tag(head + body, 'html')
     return status
 
+def get_etag(content):
+    '''
+    Get the ETag of a content.
+    Param
+    content: the content as bytes
+    Return
+    (str): a weak ETag of the content
+    '''
+    return 'W/"' + hashlib.blake2b(content, digest_size=8).hexdigest() + '"'
+
+def etag_matches(header, etag):
+    '''
+    Check an If-None-Match header against an ETag with the weak comparison.
+    Param
+    header: the header value, or None if it was not sent
+    etag: the current ETag
+    Return
+    (bool): whether the client has the current content
+    '''
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith('W/') else tag) == etag:
+            return True
+    return False
+
 def get_head():
     '''
     Get the header for the status html page
@@ -202,41 +480,20 @@ def get_single_api_count(cache, api):
     (str): single api info part on the html page
     '''
     ans = wrap_with_tag(api, 'h3')
-    curr_time = now()
-    val = cache.get(api, default=b'').decode()
-    time_tags = []
-    if val:
-        time_tags = val.split(',')
-    nums = get_num(time_tags, curr_time)
-    items = ['last minute', 'last hour', 'last 24 hours', 'lifetime']
+    curr_time = int(time.time())
+    windows = []
+    for (label, width, buckets) in API_COUNT_WINDOWS:
+        windows.append((label, [api_count_key(api, width, curr_time // width - i) for i in range(buckets)]))
+    windows.append(('lifetime', [api_count_key(api, 0, 0)]))
+    # every bucket is read in one round trip
+    counts = cache.get_many([key for (label, keys) in windows for key in keys])
     lis = ''
-    for i in range(len(nums)):
-        lis += wrap_with_tag(items[i] + ': ' + str(nums[i]), 'li')  
+    for (label, keys) in windows:
+        num = sum(int(counts[key]) for key in keys if key in counts)
+        lis += wrap_with_tag(label + ': ' + str(num), 'li')
     ans += wrap_with_tag(lis, 'ul')
     return ans
 
-def get_num(time_tags, curr_time):
-    '''
-    Get the number of datetimes between each specified duration.
-    Param
-    time_tags: list of datetime in string format
-    curr_time: current datetime
-    Return
-    (tuple): number for each specified duration 
-    '''
-    last_min, last_hour, last_24_hours, lifetime = 0, 0, 0, 0
-    for time in time_tags:
-        time = datetime.strptime(time, '%d/%m/%Y %H:%M:%S')
-        duration_in_seconds = (curr_time - time).total_seconds()
-        if duration_in_seconds < 60:
-            last_min += 1
-        if duration_in_seconds < 60 * 60:
-            last_hour += 1
-        if duration_in_seconds < 24 * 60 * 60:
-            last_24_hours += 1
-        lifetime += 1
-    return (last_min, last_hour, last_24_hours, lifetime)
-
 def get_last_ten_expressions(cache):
     '''
     Get the last ten expressions
@@ -2,7 +2,12 @@
 # Author: Yuanjie Yue
 # Date: 10/16/2019
 
+import functools
 import http
+import os
+import signal
+import sys
+import time
 import utils
 import config
 import pymemcache
@@ -10,24 +15,67 @@ from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 ########################################################################
 #                   Memcache KEY - VALUE Design                        #
-#    1. Each API                                                       #
-#           key:   api itself                                          #
-#           val:   a list of datetime joined by ',' as a string        #
+#    1. Each API, counted per time bucket with incr                    #
+#           key:   api:bucket width in seconds:bucket since epoch      #
+#           val:   its requests, expiring after its window             #
+#           key:   api:lifetime                                        #
+#           val:   the requests ever made                              #
 #       Example                                                        #
-#           key:   '/api/gettime'                                      #
-#           val:   '16/10/2019 20:50:47,16/10/2019 20:50:47'           #
-#    2. Last Ten Expressions:                                          # 
+#           key:   '/api/gettime:60:26204450'                          #
+#           val:   '42'                                                #
+#    2. Last Ten Expressions, replaced with gets/cas                   #
 #           key:   'last_ten_exprs'                                    #
 #           value: a list of expressions joined by ',' as a string     #
-#                  (the number of expressions are no more than 10)     #
+#                  (no more than 10, each cut to 256 characters)       #
 #       Example                                                        #
 #           key:   'last_ten_exprs'                                    #
 #           val:   '1,1+1,-2,-2+3'                                     #
 ########################################################################
 
-cache = pymemcache.client.base.Client((config.CACHE_SERVER, config.CACHE_PORT))
+def cache_client():
+    return pymemcache.client.base.Client((config.CACHE_SERVER, config.CACHE_PORT))
+
+cache = cache_client()
+
+rate_limiter = utils.RateLimiter(config.WEB_API_RATE_LIMIT, config.WEB_API_RATE_BURST,
+                                 config.WEB_API_RATE_LIMIT_CLIENTS, config.WEB_API_RATE_LIMIT_SHARDS)
+admission = utils.Admission(config.WEB_API_HANDLERS, config.WEB_API_QUEUE_MAX, config.WEB_API_QUEUE_DEADLINE)
+
+def limited(method):
+    '''
+    Answer requests over the rate limit of their client with 429, bodies
+    that cost more than WEB_API_RATE_BURST with 413, a malformed
+    Content-Length with 400 and requests that cannot get a handler in time
+    with 503, before the decorated request method runs.
+    '''
+    @functools.wraps(method)
+    def handle(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.refuse(400)
+            return
+        cost = 1 + length // config.WEB_API_RATE_COST_BYTES
+        if rate_limiter.rate > 0 and cost > rate_limiter.burst:
+            # no bucket ever holds enough tokens for this body
+            self.refuse(413)
+            return
+        if not rate_limiter.allow(self.client_address[0], cost):
+            self.refuse(429)
+            return
+        if not admission.enter():
+            self.refuse(503)
+            return
+        try:
+            method(self)
+        finally:
+            admission.leave()
+    return handle
 
 class Handler(BaseHTTPRequestHandler):
+    @limited
     def do_GET(self):
         # Handle GET request of different URL path
         self.print_header_line()
@@ -42,19 +90,31 @@ class Handler(BaseHTTPRequestHandler):
             self.wfile.write(curr_time)
         elif self.path == '/status.html':
             resp_html = utils.get_status(cache).encode()
-            self.send_response(200)
-            self.send_header('Content-type','text/html')
-            self.send_header('Content-Length', str(len(resp_html)))
-            self.end_headers()
-            # Send the html message
-            print('Server send:', resp_html)
-            self.wfile.write(resp_html)
+            # the counts live in memcache, so the page is hashed as read
+            etag = utils.get_etag(resp_html)
+            if utils.etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', config.STATUS_CACHE_CONTROL)
+                self.end_headers()
+                print('Server send: 304 for', etag)
+            else:
+                self.send_response(200)
+                self.send_header('Content-type','text/html')
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', config.STATUS_CACHE_CONTROL)
+                self.send_header('Content-Length', str(len(resp_html)))
+                self.end_headers()
+                # Send the html message
+                print('Server send:', resp_html)
+                self.wfile.write(resp_html)
         else:  
             self.send_response(404)
             self.end_headers()
         self.print_footer_line()
         return
 
+    @limited
     def do_POST(self):
         # Handle POST request of different URL path
         self.print_header_line()
@@ -83,6 +143,17 @@ class Handler(BaseHTTPRequestHandler):
         self.print_footer_line()
         return
 
+    def refuse(self, code):
+        # the body of a refused request is left unread, so the connection
+        # cannot be reused; only a refusal for load may be sent again
+        self.send_response(code)
+        if code in (429, 503):
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
     def print_header_line(self):
         print('+----------------------------------+')
         print('Server connected by client at:', self.client_address)
@@ -91,11 +162,69 @@ class Handler(BaseHTTPRequestHandler):
     def print_footer_line(self):
         print('+----------------------------------+')
 
+class PreforkHTTPServer(ThreadingHTTPServer):
+    # every worker listens on the port, the kernel spreads new connections
+    allow_reuse_port = True
+
 def run(server_class=ThreadingHTTPServer, handler_class=Handler):
     server_address = (config.WEB_API_SERVER, config.WEB_API_PORT)
     httpd = server_class(server_address, handler_class)
     print('Web_API_Server started. Waiting for connnection...')
     httpd.serve_forever()
+
+def run_prefork(workers, handler_class=Handler):
+    '''
+    Run the given number of worker processes on the same port with
+    SO_REUSEPORT and restart any worker that exits. The api counts and the
+    last ten expressions are kept in memcache, so every worker reports
+    the numbers of all of them.
+    '''
+    # pid -> (worker index, start time)
+    children = {}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            global cache
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                # a connection must not be shared with the other processes
+                cache = cache_client()
+                server_address = (config.WEB_API_SERVER, config.WEB_API_PORT)
+                PreforkHTTPServer(server_address, handler_class).serve_forever()
+            finally:
+                os._exit(1)
+        children[pid] = (worker, time.monotonic())
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in range(workers):
+            spawn(worker)
+        print(f'Web_API_Server started with {workers} workers. Waiting for connnection...')
+        while True:
+            pid, status = os.wait()
+            if pid not in children:
+                continue
+            (worker, started) = children.pop(pid)
+            print(f'Worker {worker} exited with status {status}, restarting')
+            # a worker crashing right away is not restarted in a tight loop
+            if time.monotonic() - started < config.WEB_API_RESTART_DELAY:
+                time.sleep(config.WEB_API_RESTART_DELAY)
+            spawn(worker)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
+
+if config.WEB_API_WORKERS > 0:
+    run_prefork(config.WEB_API_WORKERS)
 run()
 
 